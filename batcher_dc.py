@@ -13,6 +13,7 @@ import pandas as pd
 import argparse
 #args = get_args()
 import spacy
+from corpus.embeddingstore import EmbeddingStore
 nlp=spacy.load('en_core_web_sm')
 
 class DialogBatcher:
@@ -52,23 +53,15 @@ class DialogBatcher:
         # self.n_all = len(self.all['x'])
 
         self.itos = {v: k for k, v in self.stoi.items()}
-        self.vocab_glove = defaultdict(list)
-        with open('data/samples/jointEmbedding.txt', 'r') as f:
-            joint_emb = f.readlines()
-        for l in joint_emb:
-            l = l.replace('\n', '').split()
-            word = l[0]
-            vec = l[1:]
-            self.vocab_glove[word] = vec
-
-        # get pretrained vectors
+
+        # get pretrained vectors (only the rows of our vocabulary are read from the memory mapped store)
+        store = EmbeddingStore('data/samples/jointEmbedding.txt')
+        words = list(self.stoi.keys())
+        vec_dim = store.dim
+        vocab_vectors, found = store.gather(words)
         self.vectors = np.zeros((len(self.itos)+1, vec_dim))
-        for k, v in self.vocab_glove.items():
-            #self.vectors[self.stoi[k.encode('utf-8')]] = v
-            try:
-                self.vectors[self.stoi[k]] = v
-            except KeyError:
-                continue
+        ids = np.array([self.stoi[w] for w in words], dtype=np.int64)
+        self.vectors[ids[found]] = vocab_vectors[found]
 
         self.vectors = torch.from_numpy(self.vectors.astype(np.float32))
 
@@ -0,0 +1,221 @@
+"""
+Columnar, memory mapped cache of the preprocessed samples.
+
+A cache is a directory holding, for each split, the samples [input, target, triples, intent] as flat int32 arrays:
+    <split>.encoder.npy / <split>.encoderOffsets.npy   the input ids of all the samples, and where each one starts
+    <split>.decoder.npy / <split>.decoderOffsets.npy   the target ids
+    <split>.kb.npy / <split>.kbOffsets.npy             the (num triples, 3) KB triples
+    <split>.intents.npy                                the intent id of each sample
+    <split>.kbMask.npy                                 for each target word, 1 if it is an entity of the sample KB
+                                                       (aligned with <split>.decoder.npy)
+and a header.json, written last, with the vocabulary and the fingerprint of what the cache was built from (cache
+version, preprocessing parameters and sha1 of the source json files). A cache whose fingerprint doesn't match the
+current one is stale and has to be rebuilt.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+CACHE_VERSION = 2
+
+
+def targetKbMask(target, triples):
+    """Flag the target words which are the subject or object of one of the triples
+    Args:
+        target (list<int>): the target word ids
+        triples (list<list<int>>): the KB of the sample
+    Return:
+        list<int>: 1 for the KB entities, 0 for the other words
+    """
+    entities = {triple[0] for triple in triples} | {triple[2] for triple in triples}
+    return [1 if word in entities else 0 for word in target]
+
+
+def fileDigest(fileName, chunkSize=1 << 20):
+    """Return the sha1 of the file content, or None if the file doesn't exist
+    """
+    if not os.path.isfile(fileName):
+        return None
+    digest = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SampleColumns:
+    """The samples of one split, stored column by column
+    Behave like the list of samples it replaces: len(), iteration, indexing and slicing return
+    [input, target, triples, intent, targetKbMask] lists.
+    """
+
+    columns = ('encoder', 'encoderOffsets', 'decoder', 'decoderOffsets', 'kb', 'kbOffsets', 'intents', 'kbMask')
+
+    def __init__(self, arrays):
+        """
+        Args:
+            arrays (dict<str, np.array>): one array per column name
+        """
+        for name in self.columns:
+            setattr(self, name, arrays[name])
+        self.order = np.arange(len(self.intents))  # Shuffling only permutes this index, the columns are read only
+
+    @classmethod
+    def fromSamples(cls, samples):
+        """Build the columns from a list of samples (the target KB masks are computed here)
+        Args:
+            samples (list<[list<int>, list<int>, list<list<int>>, int]>)
+        """
+        def flatten(sequences, width=None):
+            lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+            offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            flat = [x for s in sequences for x in s]
+            if width is None:
+                return np.array(flat, dtype=np.int32), offsets
+            return np.array(flat, dtype=np.int32).reshape(-1, width), offsets
+
+        arrays = {}
+        arrays['encoder'], arrays['encoderOffsets'] = flatten([s[0] for s in samples])
+        arrays['decoder'], arrays['decoderOffsets'] = flatten([s[1] for s in samples])
+        arrays['kb'], arrays['kbOffsets'] = flatten([s[2] for s in samples], width=3)
+        arrays['intents'] = np.array([s[3] for s in samples], dtype=np.int32)
+        arrays['kbMask'] = np.array([x for s in samples for x in targetKbMask(s[1], s[2])], dtype=np.int8)
+        return cls(arrays)
+
+    @staticmethod
+    def path(dirName, split, name):
+        return os.path.join(dirName, '{}.{}.npy'.format(split, name))
+
+    @classmethod
+    def load(cls, dirName, split, mmap=True):
+        """Open the columns of the split (memory mapped: nothing is read before the samples are accessed)
+        """
+        return cls({name: np.load(cls.path(dirName, split, name), mmap_mode='r' if mmap else None)
+                    for name in cls.columns})
+
+    def save(self, dirName, split):
+        """Write the columns, in the current sample order
+        """
+        ordered = self
+        if not np.array_equal(self.order, np.arange(len(self.order))):
+            ordered = SampleColumns.fromSamples(list(self))
+        for name in self.columns:
+            np.save(self.path(dirName, split, name), np.ascontiguousarray(getattr(ordered, name)))
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        for i in self.order:
+            yield self.sample(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.sample(i) for i in self.order[index]]
+        return self.sample(self.order[index])
+
+    def sample(self, i):
+        """Return the i-th stored sample (ignoring the shuffling)
+        Return:
+            list: [input, target, triples, intent, targetKbMask]
+        """
+        return [self.encoder[self.encoderOffsets[i]:self.encoderOffsets[i + 1]].tolist(),
+                self.decoder[self.decoderOffsets[i]:self.decoderOffsets[i + 1]].tolist(),
+                self.kb[self.kbOffsets[i]:self.kbOffsets[i + 1]].tolist(),
+                int(self.intents[i]),
+                self.kbMask[self.decoderOffsets[i]:self.decoderOffsets[i + 1]].tolist()]
+
+    def shuffle(self):
+        np.random.shuffle(self.order)
+
+    def encoderLengths(self):
+        return np.diff(self.encoderOffsets)[self.order]
+
+    def decoderLengths(self):
+        return np.diff(self.decoderOffsets)[self.order]
+
+    def kbSizes(self):
+        return np.diff(self.kbOffsets)[self.order]
+
+
+class DatasetCache:
+    """A cache directory: the vocabulary/metadata header and the columns of each split
+    """
+
+    headerName = 'header.json'
+
+    def __init__(self, dirName, sources, params):
+        """
+        Args:
+            dirName (str): the cache directory
+            sources (list<str>): the files the samples are extracted from
+            params (dict): the preprocessing parameters (json serializable)
+        """
+        self.dirName = dirName
+        self.sources = sources
+        self.params = params
+
+    def fingerprint(self):
+        """What the cache content depends on
+        """
+        return {
+            'version': CACHE_VERSION,
+            'params': self.params,
+            'sources': {os.path.basename(source): fileDigest(source) for source in self.sources},
+        }
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.dirName, self.headerName))
+
+    def readHeader(self):
+        with open(os.path.join(self.dirName, self.headerName), 'r') as f:
+            return json.load(f)
+
+    def isValid(self):
+        """Return True if the cache exists and was built from the current sources and parameters
+        A source file which isn't available anymore can't be checked, and is trusted.
+        """
+        if not self.exists():
+            return False
+        stored = self.readHeader()['fingerprint']
+        current = self.fingerprint()
+        if stored['version'] != current['version'] or stored['params'] != current['params']:
+            print('Dataset cache {} was built with other parameters'.format(self.dirName))
+            return False
+        for source, digest in current['sources'].items():
+            if digest is not None and stored['sources'].get(source) != digest:
+                print('Dataset cache {} is older than {}'.format(self.dirName, source))
+                return False
+        return True
+
+    def save(self, metadata, splits):
+        """Write the cache (the header last, so an interrupted save leaves no valid cache)
+        Args:
+            metadata (dict): json serializable data stored in the header
+            splits (dict<str, SampleColumns>): the samples of each split
+        """
+        os.makedirs(self.dirName, exist_ok=True)
+        headerPath = os.path.join(self.dirName, self.headerName)
+        if os.path.isfile(headerPath):
+            os.remove(headerPath)
+
+        for split, columns in splits.items():
+            columns.save(self.dirName, split)
+
+        header = {'fingerprint': self.fingerprint(), 'splits': list(splits), 'metadata': metadata}
+        with open(headerPath, 'w') as f:
+            json.dump(header, f)
+
+    def load(self, mmap=True):
+        """
+        Return:
+            dict: the metadata given to save
+            dict<str, SampleColumns>: the samples of each split
+        """
+        header = self.readHeader()
+        splits = {split: SampleColumns.load(self.dirName, split, mmap) for split in header['splits']}
+        return header['metadata'], splits
@@ -0,0 +1,153 @@
+"""
+Binary, memory mapped copy of a GloVe/joint embedding text file.
+
+The text file is converted once into five .npy files next to it:
+    <name>.npy          float32 matrix, one row per word, in the order of the text file
+    <name>.words.npy    the UTF-8 bytes of all the words, concatenated in the order of the matrix rows
+    <name>.offsets.npy  where the bytes of each row's word start (one more entry for the end of the last word)
+    <name>.hashes.npy   the sorted 64 bits hashes of the distinct words (see wordHash)
+    <name>.index.npy    the matrix row of each hash
+All of them are opened with mmap_mode, so only the rows which are looked up are ever read from disk. A word costs its
+own UTF-8 length plus 24 bytes, whatever the length of the longest word of the file.
+"""
+
+import os
+import hashlib
+import numpy as np
+from tqdm import tqdm  # Progress bar
+
+
+def wordHash(word):
+    """Stable 64 bits hash of a word (the builtin hash of str changes with each process)
+    """
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class EmbeddingStore:
+    """Memory mapped embedding matrix with a hashed vocabulary index
+    """
+
+    def __init__(self, fileName):
+        """
+        Args:
+            fileName (str): the embedding text file (converted on first use, or when it is newer than its copy)
+        """
+        self.fileName = fileName
+        basePath = os.path.splitext(fileName)[0]
+        self.vectorsPath = basePath + '.npy'
+        self.wordsPath = basePath + '.words.npy'
+        self.offsetsPath = basePath + '.offsets.npy'
+        self.hashesPath = basePath + '.hashes.npy'
+        self.indexPath = basePath + '.index.npy'
+
+        if self.isStale():
+            self.convert()
+
+        self.vectors = np.load(self.vectorsPath, mmap_mode='r')
+        self.wordBytes = np.load(self.wordsPath, mmap_mode='r')
+        self.offsets = np.load(self.offsetsPath, mmap_mode='r')
+        self.hashes = np.load(self.hashesPath, mmap_mode='r')
+        self.index = np.load(self.indexPath, mmap_mode='r')
+        self.dim = self.vectors.shape[1]
+
+    def isStale(self):
+        """Return True if the binary copy is missing or older than the text file
+        """
+        for path in (self.vectorsPath, self.wordsPath, self.offsetsPath, self.hashesPath, self.indexPath):
+            if not os.path.isfile(path):
+                return True
+            if os.path.isfile(self.fileName) and os.path.getmtime(path) < os.path.getmtime(self.fileName):
+                return True
+        return False
+
+    def convert(self):
+        """Parse the text file (one "word v1 v2 ..." line per word) and write the binary copy
+        If a word appears several times, the last vector is kept (as a dict built from the file would do).
+        """
+        print('Converting {} to a binary embedding store...'.format(self.fileName))
+
+        # 1st pass: number of vectors, dimension and size of the words (a "count dim" fastText header is skipped)
+        numVectors = 0
+        numBytes = 0
+        dim = None
+        with open(self.fileName, 'r') as embFile:
+            for line in embFile:
+                split = line.strip().split(' ')
+                if dim is None:
+                    if len(split) == 2 and split[0].isdigit() and split[1].isdigit():
+                        continue
+                    dim = len(split) - 1
+                if len(split) - 1 == dim:
+                    numVectors += 1
+                    numBytes += len(split[0].encode('utf-8'))
+
+        # 2nd pass: fill the matrix and the word bytes directly on disk
+        vectors = np.lib.format.open_memmap(self.vectorsPath, mode='w+', dtype=np.float32, shape=(numVectors, dim))
+        wordBytes = np.lib.format.open_memmap(self.wordsPath, mode='w+', dtype=np.uint8, shape=(numBytes,))
+        offsets = np.zeros(numVectors + 1, dtype=np.int64)
+        hashes = np.zeros(numVectors, dtype=np.uint64)
+        row = 0
+        with open(self.fileName, 'r') as embFile:
+            for line in tqdm(embFile, total=numVectors, desc='Convert embedding', leave=False):
+                split = line.strip().split(' ')
+                if len(split) - 1 != dim:
+                    continue
+                vectors[row] = np.asarray(split[1:], dtype=np.float32)
+                word = split[0].encode('utf-8')
+                offsets[row + 1] = offsets[row] + len(word)
+                wordBytes[offsets[row]:offsets[row + 1]] = np.frombuffer(word, dtype=np.uint8)
+                hashes[row] = wordHash(split[0])
+                row += 1
+        vectors.flush()
+        wordBytes.flush()
+        del vectors, wordBytes
+        np.save(self.offsetsPath, offsets)
+
+        # Index sorted by hash. Equal hashes are taken for the same word (a collision between two distinct words,
+        # which has a negligible probability with 64 bits, would only make one of them not found)
+        order = np.argsort(hashes, kind='stable')
+        sortedHashes = hashes[order]
+        last = np.ones(len(sortedHashes), dtype=bool)  # Keep the last occurrence of each word
+        last[:-1] = sortedHashes[:-1] != sortedHashes[1:]
+        np.save(self.hashesPath, sortedHashes[last])
+        np.save(self.indexPath, order[last].astype(np.int64))
+
+    def word(self, row):
+        """Return the word of a matrix row
+        """
+        return self.wordBytes[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
+
+    def rows(self, words):
+        """Look up the matrix rows of the given words
+        Args:
+            words (list<str>): the words to look up
+        Return:
+            np.array<int>: the row of each word (0 when not found)
+            np.array<bool>: True for the words found in the store
+        """
+        if len(self.hashes) == 0 or len(words) == 0:
+            return np.zeros(len(words), dtype=np.int64), np.zeros(len(words), dtype=bool)
+
+        query = np.array([wordHash(word) for word in words], dtype=np.uint64)
+        position = np.minimum(np.searchsorted(self.hashes, query), len(self.hashes) - 1)
+        found = self.hashes[position] == query
+        rows = np.where(found, self.index[position], 0)
+        for i in np.flatnonzero(found):  # Confirm the hits against the stored words
+            found[i] = self.word(rows[i]) == words[i]
+        return np.where(found, rows, 0), found
+
+    def gather(self, words):
+        """Read the vectors of the given words
+        Return:
+            np.array<float32>: a (len(words), dim) matrix, with zero rows for the words not found
+            np.array<bool>: True for the words found in the store
+        """
+        rows, found = self.rows(words)
+        matrix = np.zeros((len(words), self.dim), dtype=np.float32)
+        matrix[found] = self.vectors[rows[found]]
+        return matrix, found
+
+    def words(self):
+        """Return all the (distinct) words of the store, sorted
+        """
+        return sorted(self.word(row) for row in self.index)
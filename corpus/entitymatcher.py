@@ -0,0 +1,122 @@
+"""
+Replace the KB entities mentioned in an utterance by _entity_N_ placeholders.
+
+The matcher is built once per conversation from its KB triples. The mentions present in a line are found with a
+single Aho-Corasick pass, then only those are rewritten, in the KB order, exactly like the triple by triple scan
+which was done before.
+"""
+
+import re
+import functools
+
+
+SUFFIX_PATTERN = re.compile("_entity_[0-9]_[a-z|']{1,}")  # Plural or possessive glued to a replaced entity
+
+
+@functools.lru_cache(maxsize=4096)
+def mentionPattern(text):
+    """Compiled pattern matching the given mention (kept as it was: the mention is not escaped)
+    """
+    return re.compile("(?![a-z]|[1-9])*" + text)
+
+
+class EntityMatcher:
+    """Finds and replaces the subjects and objects of the KB triples of one conversation
+    """
+
+    def __init__(self, textData, triples):
+        """
+        Args:
+            textData (TextData): used to convert the triple ids back to words
+            triples (list<list<int>>): the KB of the conversation
+        """
+        self.textData = textData
+        self.triples = triples
+        self.mentions = None  # list<(text id, text, prefix, token)>, in the order the KB used to be scanned
+
+    def build(self):
+        """Index the mentions of the KB (done on first use)
+        """
+        texts = {}
+        self.mentions = []
+        for ki in self.triples:
+            ki_text = self.textData.sequence2str(ki).split()
+
+            # Objects are replaced with a leading space, subjects without
+            for text, prefix, token in ((" ".join(ki_text[2].split('_')), " ", ki_text[2]),
+                                        (" ".join(ki_text[0].split('_')), "", ki_text[0])):
+                if text not in texts:
+                    texts[text] = len(texts)
+                self.mentions.append((texts[text], text, prefix, token))
+
+        self.texts = list(texts)
+        # A replacement can only create a new mention inside the "_entity_N_" marker itself
+        self.markerTexts = {i for i, text in enumerate(self.texts) if text.isdigit() or text in "entity"}
+        self.buildAutomaton()
+
+    def buildAutomaton(self):
+        """Aho-Corasick automaton over the mention texts
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        for i, text in enumerate(self.texts):
+            state = 0
+            for char in text:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].add(i)
+
+        queue = list(self.goto[0].values())
+        for state in queue:  # Breadth first, the queue grows while iterating
+            for char, nextState in self.goto[state].items():
+                queue.append(nextState)
+                failState = self.fail[state]
+                while failState and char not in self.goto[failState]:
+                    failState = self.fail[failState]
+                self.fail[nextState] = self.goto[failState].get(char, 0)
+                self.output[nextState] |= self.output[self.fail[nextState]]
+
+    def find(self, line):
+        """Return the ids of all the mention texts occurring in the line (overlapping occurrences included)
+        """
+        found = set(self.output[0])  # Empty mention
+        state = 0
+        for char in line:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return found
+
+    def substitute(self, line):
+        """Replace the KB mentions of the line by _entity_N_ placeholders
+        Args:
+            line (str): the tokenized, lower cased line
+        Return:
+            str: the rewritten line
+            dict<str, str>: the placeholder -> entity word mapping
+        """
+        if self.mentions is None:
+            self.build()
+
+        found = self.find(line)
+        count = 0
+        entities = {}
+        for textId, text, prefix, token in self.mentions:
+            if textId not in found and textId not in self.markerTexts:
+                continue
+            if text in line:  # The line might have changed since the scan
+                count = count + 1
+                marker = "_entity_" + str(count) + "_"
+                line_temp = mentionPattern(text).sub(prefix + marker, line)
+                line_temp = SUFFIX_PATTERN.sub(marker, line_temp)
+                if marker in line_temp.split(" "):
+                    line = line_temp
+                    entities[marker] = token
+        return line, entities
@@ -19,11 +19,15 @@ class KvretData:
 
     """
 
-    def __init__(self, fileName):
+    def __init__(self, fileName, lazy=False, keepLines=True):
         """
         Args:
             dirName (string): directory where to load the corpus
+            lazy (bool): if True, nothing is loaded here and getConversations streams the file one dialogue at a time
+            keepLines (bool): if False, the global lineID -> line index is not built
         """
+        self.fileName = fileName
+        self.lazy = lazy
         self.lines = {}
         self.conversations = []
 
@@ -46,72 +50,81 @@ class KvretData:
         #
        # dataStores = PreProcess(os.path.join(dirName,'kvret_train_public.json'), os.path.join(dirName,'kvret_test_public.json'))
 
-        [self.lines, self.conversations] = self.loadLines(fileName)
+        if not lazy:
+            [self.lines, self.conversations] = self.loadLines(fileName, keepLines)
         # self.conversations = self.loadConversations(os.path.join(dirName, "kvret_train_conversations.txt"),
         #                                             CONVERSATIONS_FIELDS)
         # print self.conversations[1]
 
-    def loadLines(self, fileName):
+    def loadLines(self, fileName, keepLines=True):
         """
         Args:
             fileName (str): file to load
-            field (set<str>): fields to extract
+            keepLines (bool): also return the lineID -> line index
         Return:
             dict<dict<str>>: the extracted fields for each line
         """
-        conversation = []
-        lines = {}
+        lines = {} if keepLines else None
+        conversation = list(self.iterConversations(fileName, lines))
+        return [lines if keepLines else {}, conversation]
+
+    def iterConversations(self, fileName, lines=None):
+        """Stream the conversations of a KVRET file, one dialogue is decoded at a time
+        Args:
+            fileName (str): file to load
+            lines (dict): if given, filled with the lineID -> line index
+        Return:
+            iter<dict>: the conversation objects
+        """
         conversationId = 0
         lineID = 1
         print(fileName)
-        with open(fileName, 'r') as f:  # TODO: Solve Iso encoding pb !
-            datastore = json.load(f)
-            for dialogue in datastore:
-                convObj = {}
-                conversationId = conversationId + 1
-                convObj["lines"] = []
-                for utterence in dialogue["dialogue"]:
-                    lineID = lineID + 1
-                    lineObj = {}
-                    lineObj['turn'] = utterence['turn']
-                    lineObj['utterance'] = utterence['data']['utterance']
-                    if lineObj['turn'] == 'assistant':
-                        requested = []
-                        for knowledgeRequested in utterence['data']['requested']:
-                            if utterence['data']['requested'][knowledgeRequested]:
-                                requested.append(knowledgeRequested)
-                        lineObj["requested"] = requested
-                        lineObj["slots"] = utterence['data']['slots']
+        for dialogue in iterJsonArray(fileName):
+            convObj = {}
+            conversationId = conversationId + 1
+            convObj["lines"] = []
+            for utterence in dialogue["dialogue"]:
+                lineID = lineID + 1
+                lineObj = {}
+                lineObj['turn'] = utterence['turn']
+                lineObj['utterance'] = utterence['data']['utterance']
+                if lineObj['turn'] == 'assistant':
+                    requested = []
+                    for knowledgeRequested in utterence['data']['requested']:
+                        if utterence['data']['requested'][knowledgeRequested]:
+                            requested.append(knowledgeRequested)
+                    lineObj["requested"] = requested
+                    lineObj["slots"] = utterence['data']['slots']
+                if lines is not None:
                     lines[lineID] = lineObj
-                    convObj["lines"].append(lineObj)
-                # EOS
-                convObj[conversationId] = conversationId
-
-                # Get KB entries
-                predicate = []
-                subject = None
-                convObj["intent"] = dialogue["scenario"]["task"]["intent"]
-                for col in dialogue["scenario"]["kb"]["column_names"]:
-                    if subject is None:
-                        subject = col
-                        predicate.append(col)
-                    else:
-                        predicate.append(col)
-                triples = []
-                if dialogue["scenario"]["kb"]["items"] is not None:
-                    for items in dialogue["scenario"]["kb"]["items"]:
-                        for pred in predicate:
-                            if (pred in items):
-                                if items[pred] == items[subject]:
-                                    triples.append([convObj["intent"], pred, items[pred]])
-                                else:
-                                    triples.append([items[subject], pred, items[pred]])
+                convObj["lines"].append(lineObj)
+            # EOS
+            convObj[conversationId] = conversationId
+
+            # Get KB entries
+            predicate = []
+            subject = None
+            convObj["intent"] = dialogue["scenario"]["task"]["intent"]
+            for col in dialogue["scenario"]["kb"]["column_names"]:
+                if subject is None:
+                    subject = col
+                    predicate.append(col)
+                else:
+                    predicate.append(col)
+            triples = []
+            if dialogue["scenario"]["kb"]["items"] is not None:
+                for items in dialogue["scenario"]["kb"]["items"]:
+                    for pred in predicate:
+                        if (pred in items):
+                            if items[pred] == items[subject]:
+                                triples.append([convObj["intent"], pred, items[pred]])
                             else:
-                                triples.append([items[subject], pred, "-"])
-                convObj["kb"] = triples
+                                triples.append([items[subject], pred, items[pred]])
+                        else:
+                            triples.append([items[subject], pred, "-"])
+            convObj["kb"] = triples
 
-                conversation.append(convObj)
-        return [lines, conversation]
+            yield convObj
 
     def loadConversations(self, fileName, fields):
         """
@@ -148,4 +161,59 @@ class KvretData:
         return ""
 
     def getConversations(self):
+        if self.lazy:
+            return self.iterConversations(self.fileName)
         return self.conversations
+
+
+def iterJsonArray(fileName, chunkSize=1 << 16):
+    """Incrementally decode a file holding a top-level JSON array
+    Only the element being decoded is kept in memory, so the memory stays flat in the number of elements.
+    Args:
+        fileName (str): file to load
+        chunkSize (int): number of characters read at a time
+    Return:
+        iter<Obj>: the decoded elements, in order
+    Raise:
+        ValueError: if the file ends before the array is closed
+    """
+    decoder = json.JSONDecoder()
+    with open(fileName, 'r') as f:  # TODO: Solve Iso encoding pb !
+        buffer = ''
+        eof = False
+        opened = False
+        while True:
+            # Skip the whitespaces, the opening bracket and the commas between two elements
+            pos = 0
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','
+                                         or (buffer[pos] == '[' and not opened)):
+                opened = opened or buffer[pos] == '['
+                pos += 1
+            buffer = buffer[pos:]
+
+            if buffer.startswith(']'):
+                return
+            if not buffer:
+                if eof:  # As json.load, a truncated file is an error rather than a shorter array
+                    raise ValueError('Unterminated JSON array in {}'.format(fileName))
+                buffer = f.read(chunkSize)
+                eof = not buffer
+                continue
+
+            try:
+                element, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = None
+            complete = end is not None and (eof or end < len(buffer))
+            if complete and not eof and isinstance(element, (int, float)) and not isinstance(element, bool):
+                # A number is only complete once followed by a delimiter (the beginning "1." of "1.25" decodes as 1)
+                complete = buffer[end] in ', \t\n\r]'
+            if not complete:  # Element not complete yet, read more
+                chunk = f.read(max(chunkSize, len(buffer)))
+                eof = not chunk
+                buffer += chunk
+                continue
+            yield element
+            buffer = buffer[end:]
@@ -26,13 +26,23 @@ import math  # For float comparison
 import os  # Checking file existance
 import random
 import re
+import queue  # Prefetched batches
+import threading
+import itertools
 import string
 import collections
 from collections import defaultdict
 from corpus.kvretdata import KvretData
+from corpus.entitymatcher import EntityMatcher
+from corpus.embeddingstore import EmbeddingStore
+from corpus.datasetcache import DatasetCache, SampleColumns, targetKbMask
 import csv
 
 
+NLP_MODEL = 'en_core_web_sm'  # spaCy model used to tokenize the corpus
+BUCKET_POOL_BATCHES = 50  # Number of batches sorted together by genBucketSamples
+DEGREES_PATTERN = re.compile(r"\b(\d{2} - \d{2,3}(f| degrees|s)+)\b")  # 50 - 60 degrees ranges in weather answers
+
 
 class Batch:
     """Struct containing batches info
@@ -51,6 +61,28 @@ class Batch:
         self.encoderMaskSeqs = []
         self.decoderMaskSeqs = []
 
+    def toTensors(self, pin=False):
+        """Build the (max_len x batch_size) tensors given to the models
+        Args:
+            pin (bool): put the tensors in page-locked memory (faster copies to the GPU)
+        Return:
+            Batch: self, with the encoderTensor, targetTensor, encoderMaskTensor, decoderMaskTensor and
+                targetKbMaskTensor fields set, and kbTensor (batch_size x num_triples x 3, padded with -1)
+        """
+        def tensor(seqs, dtype):
+            t = torch.as_tensor(seqs, dtype=dtype).t().contiguous()
+            return t.pin_memory() if pin and torch.cuda.is_available() else t
+
+        self.encoderTensor = tensor(self.encoderSeqs, torch.long)
+        self.targetTensor = tensor(self.targetSeqs, torch.long)
+        self.encoderMaskTensor = tensor(self.encoderMaskSeqs, torch.float)
+        self.decoderMaskTensor = tensor(self.decoderMaskSeqs, torch.float)
+        self.targetKbMaskTensor = tensor(self.targetKbMask, torch.long)
+        self.kbTensor = torch.as_tensor(self.kbArray, dtype=torch.long)
+        if pin and torch.cuda.is_available():
+            self.kbTensor = self.kbTensor.pin_memory()
+        return self
+
 
 class TextData:
     """Dataset class
@@ -69,10 +101,13 @@ class TextData:
         """
         return list(TextData.availableCorpus.keys())
 
-    def __init__(self,dataFile, validFile, testFile, pretrained_emb_file=None, useGlove = None):
+    def __init__(self,dataFile, validFile, testFile, pretrained_emb_file=None, useGlove = None, nlpWorkers=0,
+                 nlpBatchSize=256):
         """Load all conversations
         Args:
             args: parameters of the model
+            nlpWorkers (int): number of spaCy processes used to build the corpus (0 parses one utterance at a time)
+            nlpBatchSize (int): number of utterances sent to each nlp.pipe batch
         """
         # Model parameters
         self.vocabularySize = 0
@@ -85,8 +120,8 @@ class TextData:
         self.testcorpus = os.path.join(testFile)
 
         basePath = self._constructBasePath()
-        self.fullSamplesPath = basePath +'.pkl'  # Full sentences length/vocab
-        self.filteredSamplesPath = basePath + 'filtered.pkl'
+        self.fullSamplesPath = basePath  # Full sentences length/vocab (cache directory)
+        self.filteredSamplesPath = basePath + 'filtered'
 
         self.padToken = -1  # Padding
         self.goToken = -1  # Start of sequence
@@ -108,6 +143,11 @@ class TextData:
         self.intent2id={}
         self.id2intent = {}
         self.nlp=None
+        self.nlpWorkers = nlpWorkers
+        self.nlpBatchSize = nlpBatchSize
+        self.parsedLines = {}  # Pre-parsed utterances (cleaned line -> (tokens, entities)), filled by parseConversations
+        self.bucketBatches = False  # Group the samples of similar lengths and only pad to the batch max (iterBatches)
+        self.maxBatchTokens = None  # If set, the batches are cut by number of padded tokens instead of batch size
         self.loadCorpus()
 
 
@@ -120,48 +160,13 @@ class TextData:
         self.pretrained_emb =None
 
         if pretrained_emb_file:
-            if useGlove:
-                print("Loading Glove embedding from disks...")
-                self.word_to_embedding_dict = self.load_embedding_from_disks(self.pretrained_emb_file)
-                embedding_size = len(self.word_to_embedding_dict["<pad>"])
-                emb_matrix = np.zeros([self.getVocabularySize(), embedding_size], int)
-
-                for i in range(self.getVocabularySize()):
-                    i_embedding = self.word_to_embedding_dict[self.id2word[i]]
-                    if len(self.id2word[i].split("_")) >1:
-                        for word in self.id2word[i].split("_"):
-                            i_embedding = np.add(i_embedding, self.word_to_embedding_dict[word])
-                        emb_matrix[i] = i_embedding/ len(self.id2word[i].split("_"))
-                    else:
-                        emb_matrix[i] = i_embedding
-
-                self.pretrained_emb = torch.from_numpy(emb_matrix)
-
-                print("Glove Embedding loaded from disks.")
-            else:
-
-                print("Loading Joint embedding from disks...")
-                self.word_to_embedding_dict = self.load_embedding_from_disks(self.pretrained_emb_file)
-                embedding_size = len(self.word_to_embedding_dict.get("30"))
-                emb_matrix = np.zeros((len(self.id2word), 300))
-
-                # for k, v in self.word_to_embedding_dict.items():
-                #     print(k)
-                # for i in range(len(self.id2word)):
-                #
-                #     emb_matrix[self.word2id[i]] = self.word_to_embedding_dict[self.id2word[i]]
-
-                for i in range(self.getVocabularySize()):
-                    i_embedding = self.word_to_embedding_dict[self.id2word[i]]
-                    emb_matrix[i] = i_embedding
-
-
-                self.pretrained_emb = torch.from_numpy(emb_matrix.astype(np.float32))
-
-                print("Joint Embedding loaded from disks.")
-
-
-
+            name = "Glove" if useGlove else "Joint"
+            print("Loading {} embedding from disks...".format(name))
+            # GloVe has no vector for our '_'-joined KB entities: they are built from their parts
+            emb_matrix, self.embeddingStats = self.buildEmbeddingMatrix(self.pretrained_emb_file,
+                                                                        splitCompounds=bool(useGlove))
+            self.pretrained_emb = torch.from_numpy(emb_matrix)
+            print("{} Embedding loaded from disks.".format(name))
 
         # if self.playDataset:
         #     self.playDataset()
@@ -189,9 +194,11 @@ class TextData:
     def shuffle(self):
         """Shuffle the training samples
         """
-        random.shuffle(self.trainingSamples)
-        random.shuffle(self.validationSamples)
-        random.shuffle(self.testSamples)
+        for samples in (self.trainingSamples, self.validationSamples, self.testSamples):
+            if isinstance(samples, SampleColumns):
+                samples.shuffle()
+            else:
+                random.shuffle(samples)
 
     # def _createBatch(self, samples):
     #     """Create a single batch from the list of sample. The batch size is automatically defined by the number of
@@ -266,103 +273,73 @@ class TextData:
     #
     #     return batch
 
-    def createMyBatch(self, samples, transpose=True, additional_intent=False):
-        """
+    def createMyBatch(self, samples, transpose=True, additional_intent=False, padToBatch=False):
+        """Pad the samples into preallocated (batch_size x max_len) arrays
+        All the sequences are right padded (as the packed encoders expect): the inputs to maxLengthEnco (only their
+        last maxLengthEnco words are kept), the decoder inputs/targets to maxLengthDeco (only their first words).
         Args:
-
+            samples (list<Obj>): a list of samples, each sample being on the form [input, target, triples, intent]
+            padToBatch (bool): only pad to the longest sample of the batch (still bounded by maxLengthEnco/Deco)
         Return:
+            Batch: the batch, with numpy arrays (the kb_inputs also stay a list of triples)
         """
         batch = Batch()
         batchSize = len(samples)
 
+        inputLengths = np.array([len(sample[0]) for sample in samples], dtype=np.int64)
+        targetLengths = np.array([len(sample[1]) for sample in samples], dtype=np.int64)
+
+        maxLengthEnco = self.maxLengthEnco
+        maxLengthDeco = self.maxLengthDeco
+        if padToBatch:
+            maxLengthEnco = min(maxLengthEnco, max(int(inputLengths.max()), 1))
+            maxLengthDeco = min(maxLengthDeco, int(targetLengths.max()) + 1)  # + <eos>
 
-        # for i in range(batchSize):
-        #     print(samples[i][0])
-
-        #samples.sort(key=lambda x: len(x[0]), reverse=True)
-        # Create the batch tensor
-        for i in range(batchSize):
-            # Unpack the sample
-            sample = samples[i]
-
-            #batch.decoderMaskSeqs.append(list(np.ones(len(sample[1]) + 1)))
-            batch.encoderSeqs.append(sample[0])  # Reverse inputs (and not outputs), little trick as defined on the original seq2seq paper
-            #
-            # if len(sample[1])>0 and additional_intent:
-            #     batch.decoderSeqs.append([self.goToken] + sample[1][:len(sample[1])-1] + [self.eosToken]+ sample[1][len(sample[1])-1:])  # Add the <go> and <eos> tokens
-            # else:
-            batch.decoderSeqs.append( [self.goToken] + sample[1] + [self.eosToken])  # Add the <go> and <eos> tokens
-            batch.decoderMaskSeqs.append(list(np.ones(len(sample[1]) + 1)))
-            batch.targetSeqs.append(
-                batch.decoderSeqs[-1][1:])  # Same as decoder, but shifted to the left (ignore the <go>)
-            batch.encoderMaskSeqs.append(list(np.ones(len(sample[0]))))
-            batch.kb_inputs.append(sample[2])
-
-            batch.seqIntent.append(sample[3])
-
-            batch.encoderSeqsLen.append(len(sample[0]))
-            batch.decoderSeqsLen.append(len(sample[1])+1)
-
-            batch.targetKbMask.append(self.get_kb_mask(sample[1], sample[2]))
-
-            if len(batch.encoderSeqs[i]) > self.maxLengthEnco:
-                batch.encoderSeqs[i]= batch.encoderSeqs[i][self.maxLengthEnco:]
-                batch.encoderMaskSeqs[i]=batch.encoderMaskSeqs[i][self.maxLengthEnco:]
-            if len(batch.targetSeqs[i]) > self.maxLengthDeco:
-                batch.decoderSeqs[i]=batch.decoderSeqs[i][:self.maxLengthDeco]
-                batch.targetSeqs[i]= batch.targetSeqs[i][:self.maxLengthDeco]
-                batch.decoderMaskSeqs[i] = batch.decoderMaskSeqs[i][:self.maxLengthDeco]
-                batch.targetKbMask[i]= batch.targetKbMask[i][:self.maxLengthDeco]
-            # TODO: Should use tf batch function to automatically add padding and batch samples
-            # Add padding & define weight
-            batch.encoderSeqs[i] = [self.padToken] * (self.maxLengthEnco  - len(batch.encoderSeqs[i])) +batch.encoderSeqs[i]   # Left padding for the input
-            batch.encoderMaskSeqs[i] = [0] * (self.maxLengthEnco  - len(batch.encoderMaskSeqs[i])) + batch.encoderMaskSeqs[i]
-            batch.weights.append([1.0] * len(batch.targetSeqs[i]) + [0.0] * (self.maxLengthDeco - len(batch.targetSeqs[i])))
-            batch.decoderSeqs[i] = batch.decoderSeqs[i] + [self.padToken] * (self.maxLengthDeco - len(batch.decoderSeqs[i]))
-            batch.decoderMaskSeqs[i] =batch.decoderMaskSeqs[i] + [0] * (self.maxLengthDeco - len(batch.decoderMaskSeqs[i]))
-
-            batch.targetSeqs[i]  = batch.targetSeqs[i]  + [self.padToken] * (self.maxLengthDeco - len(batch.targetSeqs[i]))
-
-            batch.targetKbMask[i] = batch.targetKbMask[i]  + [self.padToken] * (self.maxLengthDeco - len(batch.targetKbMask[i]))
-            batch.kb_inputs[i] = batch.kb_inputs[i] # + [0, 0, 0]* (self.maxTriples - len(batch.kb_inputs[i]))
-
-
-        # print ("Before Reshaping %d" % len(batch.encoderSeqs))
-        # print ("Before Reshaping %d" % len(batch.decoderSeqs))
-        # Simple hack to reshape the batch
-        # if transpose:
-        #     encoderSeqsT = []  # Corrected orientation
-        #     for i in range(self.maxLengthEnco):
-        #         encoderSeqT = []
-        #         for j in range(batchSize):
-        #             encoderSeqT.append(batch.encoderSeqs[j][i])
-        #         encoderSeqsT.append(encoderSeqT)
-        #     batch.encoderSeqs = encoderSeqsT
-        #
-        #     decoderSeqsT = []
-        #     targetSeqsT = []
-        #     weightsT = []
-        #     for i in range(self.maxLengthDeco):
-        #         decoderSeqT = []
-        #         targetSeqT = []
-        #         weightT = []
-        #         for j in range(batchSize):
-        #             decoderSeqT.append(batch.decoderSeqs[j][i])
-        #             targetSeqT.append(batch.targetSeqs[j][i])
-        #             weightT.append(batch.weights[j][i])
-        #         decoderSeqsT.append(decoderSeqT)
-        #         targetSeqsT.append(targetSeqT)
-        #         weightsT.append(weightT)
-        #     batch.decoderSeqs = decoderSeqsT
-        #     batch.targetSeqs = targetSeqsT
-        #     batch.weights = weightsT
-        #     # print ("After Reshaping %d" % len(batch.encoderSeqs))
-        #     # print ("After Reshaping %d" % len(batch.decoderSeqs))
-        #
-        #     # # Debug
-        #     #self.printBatch(batch)  # Input inverted, padding should be correct
-        #     #     print(self.sequence2str(samples[0][0]))
-        #     #     print(self.sequence2str(samples[0][1]))  # Check we did not modified the original sample
+        def flatten(sequences, lengths, fromEnd=False):
+            """Concatenate the first (or last) lengths[i] elements of each sequence
+            """
+            if fromEnd:
+                sequences = (seq[len(seq) - length:] for seq, length in zip(sequences, lengths))
+            else:
+                sequences = (seq[:length] for seq, length in zip(sequences, lengths))
+            return np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.int64, count=int(lengths.sum()))
+
+        # Encoder: the flat words are scattered row by row on the mask
+        encoderLengths = np.minimum(inputLengths, maxLengthEnco)
+        encoderMask = np.arange(maxLengthEnco) < encoderLengths[:, None]
+        batch.encoderSeqs = np.full((batchSize, maxLengthEnco), self.padToken, dtype=np.int64)
+        batch.encoderSeqs[encoderMask] = flatten([sample[0] for sample in samples], encoderLengths, fromEnd=True)
+        batch.encoderMaskSeqs = encoderMask.astype(np.float32)
+
+        # Targets: words + <eos>, right padding. The decoder inputs are the targets shifted right after <go>
+        positions = np.arange(maxLengthDeco)
+        wordLengths = np.minimum(targetLengths, maxLengthDeco)
+        wordMask = positions < wordLengths[:, None]
+        batch.targetSeqs = np.full((batchSize, maxLengthDeco), self.padToken, dtype=np.int64)
+        batch.targetSeqs[wordMask] = flatten([sample[1] for sample in samples], wordLengths)
+        hasEos = targetLengths < maxLengthDeco
+        batch.targetSeqs[hasEos, targetLengths[hasEos]] = self.eosToken
+
+        batch.decoderSeqs = np.full((batchSize, maxLengthDeco), self.padToken, dtype=np.int64)
+        batch.decoderSeqs[:, 0] = self.goToken
+        batch.decoderSeqs[:, 1:] = batch.targetSeqs[:, :-1]
+
+        batch.decoderMaskSeqs = (positions < np.minimum(targetLengths + 1, maxLengthDeco)[:, None]).astype(np.float32)
+        batch.weights = batch.decoderMaskSeqs.copy()
+
+        batch.targetKbMask = np.full((batchSize, maxLengthDeco), self.padToken, dtype=np.int64)
+        kbMasks = [sample[4] if len(sample) > 4 else self.get_kb_mask(sample[1], sample[2]) for sample in samples]
+        batch.targetKbMask[wordMask] = flatten(kbMasks, wordLengths)
+
+        batch.kb_inputs = [sample[2] for sample in samples]
+        kbSizes = np.array([len(triples) for triples in batch.kb_inputs], dtype=np.int64)
+        batch.kb_inputs_mask = np.arange(max(int(kbSizes.max()), 1)) < kbSizes[:, None]
+        batch.kbArray = np.full(batch.kb_inputs_mask.shape + (3,), -1, dtype=np.int64)
+        batch.kbArray[batch.kb_inputs_mask] = np.array([triple for triples in batch.kb_inputs for triple in triples],
+                                                       dtype=np.int64).reshape(-1, 3)
+        batch.seqIntent = np.array([sample[3] for sample in samples], dtype=np.int64)
+        batch.encoderSeqsLen = encoderLengths
+        batch.decoderSeqsLen = targetLengths + 1
         return batch
 
     def getTestingBatch(self, batch_size=1):
@@ -378,26 +355,93 @@ class TextData:
 
         for samples in genNextSamples():
             batch = self.createMyBatch(samples, False)
-            batches.append(batch)
+            batches.append(batch.toTensors())
             break
         return batches
 
     def get_kb_mask(self, sentence, kb):
-        kb_mask = list(np.zeros(len(sentence)))
-        for i, word in enumerate(sentence):
-            for triple in kb:
-                if triple[0] == word or triple[2] == word:
-                    kb_mask[i]=1
-                    break
-                else:
-                    kb_mask[i]=0
-
-        assert len(kb_mask) == len(sentence)
+        """Flag the words of the sentence which are a subject or object of the KB
+        The cached samples already hold this mask (5th element)
+        """
+        return targetKbMask(sentence, kb)
 
-        return kb_mask
+    def getSamples(self, valid=False, test=False):
+        """Return the samples of the requested split
+        """
+        if valid:
+            return self.validationSamples
+        elif test:
+            return self.testSamples
+        return self.trainingSamples
 
+    def genNextSamples(self, samples, batch_size):
+        """ Generator over the mini-batch samples
+        The last batch is completed with the previous samples, so all the batches have batch_size samples
+        """
+        for i in range(0, len(samples), batch_size):
+            if len(samples) > (i + batch_size):
+                yield samples[i:(i + batch_size)]
+            else:
+                yield samples[-batch_size:]
 
+    def getSampleLengths(self, samples):
+        """Return the input and target lengths of the samples
+        Return:
+            np.array<int>, np.array<int>
+        """
+        if isinstance(samples, SampleColumns):
+            return samples.encoderLengths(), samples.decoderLengths()
+        return (np.array([len(sample[0]) for sample in samples], dtype=np.int64),
+                np.array([len(sample[1]) for sample in samples], dtype=np.int64))
+
+    def genBucketSamples(self, samples, batch_size, maxTokens=None, poolBatches=BUCKET_POOL_BATCHES):
+        """ Generator over mini-batches of samples of similar lengths
+        The (already shuffled) samples are split in pools of poolBatches batches, each pool is sorted by input then
+        target length and cut into batches, and the batches are yielded in a random order.
+        Args:
+            batch_size (int): maximum number of samples of a batch
+            maxTokens (int): if set, a batch is also closed before its padded size (batch_size x (input + target
+                length)) exceeds maxTokens
+            poolBatches (int): the sort only happens inside a pool, to keep some randomness in the batches
+        """
+        inputLengths, targetLengths = self.getSampleLengths(samples)
+        inputLengths = np.minimum(inputLengths, self.maxLengthEnco)
+        targetLengths = np.minimum(targetLengths + 1, self.maxLengthDeco)  # + <eos>
 
+        batches = []
+        poolSize = batch_size * poolBatches
+        for poolStart in range(0, len(samples), poolSize):
+            pool = np.arange(poolStart, min(poolStart + poolSize, len(samples)))
+            pool = pool[np.lexsort((targetLengths[pool], inputLengths[pool]))]
+
+            start = 0
+            while start < len(pool):
+                end = min(start + batch_size, len(pool))
+                if maxTokens:
+                    # Padded size of the batches pool[start:i+1], the first sample is always taken
+                    maxInput = np.maximum.accumulate(inputLengths[pool[start:end]])
+                    maxTarget = np.maximum.accumulate(targetLengths[pool[start:end]])
+                    tokens = np.arange(1, end - start + 1) * (maxInput + maxTarget)
+                    end = start + max(1, int(np.searchsorted(tokens, maxTokens, side='right')))
+                batches.append(pool[start:end])
+                start = end
+
+        random.shuffle(batches)
+        for indices in batches:
+            yield [samples[i] for i in indices]
+
+    def getBatchCount(self, batch_size=1, valid=False, test=False):
+        """Return the number of batches of an epoch
+        Return:
+            int: the number of batches, None when it depends on the sample lengths (maxBatchTokens)
+        """
+        if self.maxBatchTokens:
+            return None
+        numSamples = len(self.getSamples(valid, test))
+        if self.bucketBatches:  # The pools are cut independently
+            poolSize = batch_size * BUCKET_POOL_BATCHES
+            return (numSamples // poolSize) * BUCKET_POOL_BATCHES + math.ceil((numSamples % poolSize) / batch_size)
+        return math.ceil(numSamples / batch_size)
 
     def getBatches(self, batch_size=1,valid=False,test=False, transpose=True):
         """Prepare the batches for the current epoch
@@ -409,51 +453,76 @@ class TextData:
         self.batchSize = batch_size
 
         batches = []
+        for samples in self.genNextSamples(self.getSamples(valid, test), batch_size):
+            batch = self.createMyBatch(samples, transpose)
+            batches.append(batch.toTensors())
 
-        def genNextSamples():
-            """ Generator over the mini-batch training samples
-            """
-            for i in range(0, len(self.trainingSamples), batch_size):
-                if len(self.trainingSamples) > (i+batch_size):
-                    yield self.trainingSamples[i:(i + batch_size)]
-                else:
-                    yield self.trainingSamples[-batch_size:]
-
-        def genValidNextSamples():
-            """ Generator over the mini-batch training samples
-                """
-            for i in range(0, len(self.validationSamples), batch_size):
-                if len(self.validationSamples) > (i + batch_size):
-                    yield self.validationSamples[i:min(i + batch_size, len(self.validationSamples))]
-                else:
-                    yield self.validationSamples[-batch_size:]
+        return batches
 
-        def genTestNextSamples():
-            """ Generator over the mini-batch training samples
-                """
-            for i in range(0, len(self.testSamples), batch_size):
-                if len(self.testSamples) > (i + batch_size):
-                    yield self.testSamples[i:min(i + batch_size, len(self.testSamples))]
-                else:
-                    yield self.testSamples[-batch_size:]
+    def iterBatches(self, batch_size=1, valid=False, test=False, prefetch=4, pin=False):
+        """Same batches as getBatches, but created while they are consumed
+        A background thread builds the next batches (tensors included), so the first step starts immediately
+        and the batch creation overlaps the model computation.
+        If bucketBatches is set, the samples are grouped by length (see genBucketSamples) and each batch is only
+        padded to its longest sample.
+        Args:
+            prefetch (int): number of batches prepared in advance (0 creates them in the calling thread)
+            pin (bool): put the tensors in page-locked memory
+        Return:
+            iter<Batch>: the batches of the epoch
+        """
+        self.shuffle()
 
-        # TODO: Should replace that by generator (better: by tf.queue)
-        if valid:
-            for samples in genValidNextSamples():
-                batch = self.createMyBatch(samples, transpose)
-                batches.append(batch)
-        elif test:
-            for samples in genTestNextSamples():
-                batch = self.createMyBatch(samples, transpose)
-                batches.append(batch)
+        self.batchSize = batch_size
+        bucket = self.bucketBatches or bool(self.maxBatchTokens)
+        if bucket:
+            samplesIter = self.genBucketSamples(self.getSamples(valid, test), batch_size, self.maxBatchTokens)
         else:
-            for samples in genNextSamples():
-                batch = self.createMyBatch(samples, transpose)
-                batches.append(batch)
-        # remove
-        #if len(batches[len(batches)-1].encoderSeqs)!=batches or len(batches[len(batches)-1].decoderSeqs) != batch_size :
-
-        return batches
+            samplesIter = self.genNextSamples(self.getSamples(valid, test), batch_size)
+
+        def createBatch(samples):
+            return self.createMyBatch(samples, transpose=False, padToBatch=bucket).toTensors(pin)
+
+        if prefetch <= 0:
+            for samples in samplesIter:
+                yield createBatch(samples)
+            return
+
+        batchQueue = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():  # Don't block forever if the consumer is gone
+                try:
+                    batchQueue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            try:
+                for samples in samplesIter:
+                    if stop.is_set():
+                        return
+                    put(createBatch(samples))
+            except Exception as e:  # Raised again in the consumer thread
+                put(e)
+            put(end)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = batchQueue.get()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
 
     def getSampleSize(self):
         """Return the size of the dataset
@@ -484,20 +553,20 @@ class TextData:
     def loadCorpus(self):
         """Load/create the conversations data
         """
-        datasetExist = os.path.isfile(self.filteredSamplesPath)
+        datasetExist = self.hasDataset(self.filteredSamplesPath)
         if not datasetExist:  # First time we load the database: creating all files
             print('Training samples not found. Creating dataset...')
 
-            datasetExist = os.path.isfile(self.fullSamplesPath)  # Try to construct the dataset from the preprocessed entry
+            datasetExist = self.hasDataset(self.fullSamplesPath)  # Try to construct the dataset from the preprocessed entry
             if not datasetExist:
                 print('Constructing full dataset...')
                 import spacy
 
-                self.nlp = spacy.load('en_core_web_sm')
+                self.nlp = spacy.load(NLP_MODEL)
                 # Corpus creation
-                corpusData = TextData.availableCorpus['kvret'](self.corpusDir)
-                validData = TextData.availableCorpus['kvret'](self.validcorpus)
-                testData = TextData.availableCorpus['kvret'](self.testcorpus)
+                corpusData = TextData.availableCorpus['kvret'](self.corpusDir, lazy=True)
+                validData = TextData.availableCorpus['kvret'](self.validcorpus, lazy=True)
+                testData = TextData.availableCorpus['kvret'](self.testcorpus, lazy=True)
 
                 self.createFullCorpus(corpusData.getConversations())
                 self.createFullCorpus(validData.getConversations(),valid=True)
@@ -519,27 +588,32 @@ class TextData:
         else:
             self.loadDataset(self.filteredSamplesPath)
 
+    def datasetCache(self, filename):
+        """Return the cache stored in the given directory, keyed on the corpus files and preprocessing options
+        """
+        params = {'corpus': self.corpus, 'nlpModel': NLP_MODEL}
+        if filename == self.filteredSamplesPath:
+            params['vocabularySize'] = self.vocabularySize
+        return DatasetCache(filename, [self.corpusDir, self.validcorpus, self.testcorpus], params)
+
+    def hasDataset(self, filename):
+        """Return True if an up to date cache exists in the given directory
+        A pickle saved by a previous version (<filename>.pkl) is converted on the way.
+        """
+        cache = self.datasetCache(filename)
+        if not cache.exists() and os.path.isfile(filename + '.pkl'):
+            self.loadLegacyDataset(filename + '.pkl')
+            print('Converting {}.pkl to a columnar cache...'.format(filename))
+            self.saveDataset(filename)
+        return cache.isValid()
 
     def saveDataset(self, filename):
         """Save samples to file
+        The samples are converted to columns (the lists are released)
         Args:
-            filename (str): pickle filename
+            filename (str): cache directory
         """
-
-        with open(os.path.join(filename), 'wb') as handle:
-            data = {  # Warning: If adding something here, also modifying loadDataset
-                'word2id': self.word2id,
-                'id2word': self.id2word,
-                'idCount': self.idCount,
-                'intent2id': self.intent2id,
-                'id2intent': self.id2intent,
-                'trainingSamples': self.trainingSamples,
-                'validationSamples': self.validationSamples,
-                'testSamples': self.testSamples,
-                'entities':self.entities_property,
-            }
-            pickle.dump(data, handle, -1)  # Using the highest protocol available
-
+        if self.txtTrainingSamples:  # Only known when the corpus has just been created
             with open("data/samples/train.csv", "w") as output:
                 writer = csv.writer(output, lineterminator='\n')
                 writer.writerows(self.txtTrainingSamples)
@@ -547,15 +621,49 @@ class TextData:
                 writer = csv.writer(output, lineterminator='\n')
                 writer.writerows(self.txtValidationSamples)
 
+        splits = {}
+        for split in ('trainingSamples', 'validationSamples', 'testSamples'):
+            samples = getattr(self, split)
+            if not isinstance(samples, SampleColumns):
+                samples = SampleColumns.fromSamples(samples)
+                setattr(self, split, samples)
+            splits[split] = samples
+
+        metadata = {  # Warning: If adding something here, also modifying loadDataset
+            'id2word': sorted(self.id2word.items()),  # Dict with int keys are stored as pairs
+            'idCount': sorted(self.idCount.items()) if self.idCount is not None else None,
+            'id2intent': sorted(self.id2intent.items()),
+            'entities': sorted(self.entities_property.items()),
+        }
+        self.datasetCache(filename).save(metadata, splits)
+
     def loadDataset(self, filename):
         """Load samples from file
+        The samples are memory mapped and only read when accessed
+        Args:
+            filename (str): cache directory
+        """
+        print('Loading dataset from {}'.format(filename))
+        metadata, splits = self.datasetCache(filename).load()  # Warning: If adding something here, also modifying saveDataset
+        self.id2word = {wordId: word for wordId, word in metadata['id2word']}
+        self.word2id = {word: wordId for wordId, word in metadata['id2word']}
+        self.id2intent = {intentId: intent for intentId, intent in metadata['id2intent']}
+        self.intent2id = {intent: intentId for intentId, intent in metadata['id2intent']}
+        self.idCount = dict(metadata['idCount']) if metadata['idCount'] is not None else None
+        self.entities_property = {entity: prop for entity, prop in metadata['entities']}
+        self.trainingSamples = splits['trainingSamples']
+        self.validationSamples = splits['validationSamples']
+        self.testSamples = splits['testSamples']
+        self.restoreSpecialTokens()
+
+    def loadLegacyDataset(self, filename):
+        """Load the pickle written by the previous versions
         Args:
             filename (str): pickle filename
         """
-        dataset_path = os.path.join(filename)
-        print('Loading dataset from {}'.format(dataset_path))
-        with open(dataset_path, 'rb') as handle:
-            data = pickle.load(handle)  # Warning: If adding something here, also modifying saveDataset
+        print('Loading dataset from {}'.format(filename))
+        with open(filename, 'rb') as handle:
+            data = pickle.load(handle)
             self.word2id = data['word2id']
             self.id2word = data['id2word']
             self.intent2id=data['intent2id']
@@ -565,11 +673,14 @@ class TextData:
             self.validationSamples = data['validationSamples']
             self.testSamples = data['testSamples']
             self.entities_property=data['entities']
-            self.padToken = self.word2id['<pad>']
-            self.goToken = self.word2id['<go>']
-            self.eouToken = self.word2id['<eou>']
-            self.eosToken = self.word2id['<eos>']
-            self.unknownToken = self.word2id['<unknown>']  # Restore special words
+        self.restoreSpecialTokens()
+
+    def restoreSpecialTokens(self):
+        self.padToken = self.word2id['<pad>']
+        self.goToken = self.word2id['<go>']
+        self.eouToken = self.word2id['<eou>']
+        self.eosToken = self.word2id['<eos>']
+        self.unknownToken = self.word2id['<unknown>']  # Restore special words
 
     def filterFromFull(self):
         """ Load the pre-processed full corpus and filter the vocabulary / sentences
@@ -606,11 +717,12 @@ class TextData:
                         self.idCount[w] -= 1
             return merged
 
+        self.trainingSamples = list(self.trainingSamples)  # Materialize the cached columns, the ids are replaced in place
         newSamples = []
 
         # 1st step: Iterate over all words and add filters the sentences
         # according to the sentence lengths
-        for inputWords, targetWords, triples, intents in tqdm(self.trainingSamples, desc='Filter sentences:', leave=False):
+        for inputWords, targetWords, triples, intents, *_ in tqdm(self.trainingSamples, desc='Filter sentences:', leave=False):
             # inputWords = mergeSentences(inputWords, fromEnd=True)
             # targetWords = mergeSentences(targetWords, fromEnd=False)
 
@@ -677,6 +789,8 @@ class TextData:
         """Extract all data from the given vocabulary.
         Save the data on disk. Note that the entire corpus is pre-processed
         without restriction on the sentence length or vocab size.
+        Args:
+            conversations (iter<Obj>): the conversations, can be a generator (only consumed once)
         """
         # Add standard tokens
         self.padToken = self.getWordId('<pad>')  # Padding (Warning: first things to add > id=0 !!)
@@ -686,12 +800,92 @@ class TextData:
         self.unknownToken = self.getWordId('<unknown>')  # Word dropped from vocabulary
 
         # Preprocessing data
+        if self.nlpWorkers > 0:
+            conversations = self.parseConversations(conversations)
 
         for conversation in tqdm(conversations, desc='Extract conversations'):
             self.extractConversation(conversation, valid, test)
 
+        self.parsedLines.clear()
+
         # The dataset will be saved in the same order it has been extracted
 
+    def parseConversations(self, conversations):
+        """Run spaCy over the utterances of the given conversations with nlp.pipe.
+        The utterances are sent in batches over self.nlpWorkers processes and the conversations are yielded back, in
+        order, as soon as all their lines are parsed. The results are only cached here: the entity rewriting and the
+        vocabulary creation still happen in extractConversation, in the same order as the sequential path, so the
+        word ids are identical. Only the conversations read ahead by nlp.pipe are kept in memory.
+        Args:
+            conversations (iter<Obj>): the conversations to extract
+        Return:
+            iter<Obj>: the same conversations, with their lines available in self.parsedLines
+        """
+        pending = collections.deque()  # (conversation, its lines, number of lines submitted up to it)
+        refCount = collections.Counter()  # Number of pending conversations using each cached line
+
+        def lineStream():
+            submitted = 0
+            for conversation in conversations:
+                lines = [self.cleanLine(line['utterance']) for line in conversation['lines']]
+                newLines = []
+                for line in lines:
+                    if refCount[line] == 0:  # Not parsed (or being parsed) for another pending conversation
+                        newLines.append(line)
+                    refCount[line] += 1
+                submitted += len(newLines)
+                pending.append((conversation, lines, submitted))
+                for line in newLines:
+                    yield line, line
+
+        def release(lines):
+            for line in lines:
+                refCount[line] -= 1
+                if refCount[line] == 0:
+                    del refCount[line]
+                    self.parsedLines.pop(line, None)
+
+        parsed = 0
+        docs = self.nlp.pipe(lineStream(), as_tuples=True, batch_size=self.nlpBatchSize, n_process=self.nlpWorkers)
+        for doc, line in docs:
+            self.parsedLines[line] = self.docToTuple(doc)
+            parsed += 1
+            while pending and pending[0][2] <= parsed:
+                conversation, lines, _ = pending.popleft()
+                yield conversation
+                release(lines)
+        while pending:  # Trailing conversations without any new line
+            conversation, lines, _ = pending.popleft()
+            yield conversation
+            release(lines)
+
+    @staticmethod
+    def cleanLine(line):
+        """Remove the punctuation ignored by the tokenizer
+        Args:
+            line (str): the raw utterance
+        Return:
+            str: the line given to spaCy
+        """
+        return line.replace('.','').replace(',','').replace(')','').replace("(",'').replace('"','').replace('?','')\
+            .replace('>','').replace("!",'').replace(':','').replace(';','').replace("' "," ")
+
+    @staticmethod
+    def docToTuple(doc):
+        """Keep only what extractText needs from a spaCy doc (picklable and much lighter than the doc itself)
+        Return:
+            tuple<list<str>, list<tuple<str, str>>>: the token texts and the (text, label) of the named entities
+        """
+        return [token.text for token in doc], [(ent.text, ent.label_) for ent in doc.ents]
+
+    def parseLine(self, line):
+        """Return the tokens and named entities of a cleaned line, from the pre-parsed cache when available
+        """
+        parsed = self.parsedLines.get(line)
+        if parsed is None:
+            parsed = self.docToTuple(self.nlp(line))
+        return parsed
+
     def extractConversation(self, conversation, valid, test, herarical=False, truncate = False):
         """Extract the sample lines from the conversations
         Args:
@@ -707,6 +901,7 @@ class TextData:
         output_txt_conversation = []
         triples = self.extractText(conversation['kb'], kb=True, train=not(valid or test))
         targetIntent = self.extractText(conversation['intent'], intent=True, train=not(valid or test))
+        entityMatcher = EntityMatcher(self, triples)  # Shared by all the lines of the conversation
         for i in tqdm_wrap(
             range(0, len(conversation['lines']) - 1, step),  # We ignore the last line (no answer for it)
             desc='Conversation',
@@ -744,8 +939,10 @@ class TextData:
                     input_txt_conversation.append(inputLine['utterance'])
                     output_txt_conversation = targetLine['utterance']
 
-                    input_conversation.extend(self.extractText(inputLine['utterance'], triples, train=not(valid or test)))
-                    output_conversation = self.extractText(targetLine['utterance'], triples, train=not(valid or test))
+                    input_conversation.extend(self.extractText(inputLine['utterance'], triples, train=not(valid or test),
+                                                               entityMatcher=entityMatcher))
+                    output_conversation = self.extractText(targetLine['utterance'], triples, train=not(valid or test),
+                                                           entityMatcher=entityMatcher)
                     out_with_intent = output_conversation
 
                    # out_with_intent.append(self.word2id[self.id2intent[targetIntent]])
@@ -767,10 +964,11 @@ class TextData:
                 elif test:
                     self.testSamples.append([input_conversation[:], output_conversation[:], triples, targetIntent])
 
-    def extractText(self, line, triples=[], kb = False, intent=False, train=True):
+    def extractText(self, line, triples=[], kb = False, intent=False, train=True, entityMatcher=None):
         """Extract the words from a sample lines
         Args:
             line (str): a line containing the text to extract
+            entityMatcher (EntityMatcher): matcher built from triples, reused across the lines of a conversation
         Return:
             list<list<int>>: the list of sentences of word ids of the sentence
         """
@@ -820,51 +1018,22 @@ class TextData:
             return triples
 
         else:
-            line = line.replace('.','').replace(',','').replace(')','').replace("(",'').replace('"','').replace('?','')\
-                .replace('>','').replace("!",'').replace(':','').replace(';','').replace("' "," ")
-            doc=nlp(line)
-            line_tokens=[]
-            for token in doc:
-                line_tokens.append(token.text)
+            line = self.cleanLine(line)
+            line_tokens, doc_ents = self.parseLine(line)
             line = " ".join(line_tokens).lower()
 
            # line = ' '.join(re.split('(\d+)(?=[a-z]|\-)', line)).strip()
 
-            for ent in doc.ents:
-                temp=(ent.text.strip()).split(" ")
-                if len(temp)>1 and ((ent.label_ == 'TIME' and len(temp)< 3) or ent.label_ == 'GPE'):
-                    line = line.replace(ent.text.lower(),'_'.join(temp).lower())
-            count = 0
-            entities ={}
-
-            for ki in triples:
-                ki_text=self.sequence2str(ki).split()
-
-
-                object = " ".join(ki_text[2].split('_'))
-
-                if object in line:
-                    count = count + 1
-                    line_temp = re.sub("(?![a-z]|[1-9])*"+object , " _entity_" + str(count) + "_", line)
-                    line_temp = re.sub("_entity_[0-9]_[a-z|']{1,}", "_entity_" + str(count) + "_", line_temp)
-                    if "_entity_" + str(count) + "_" in line_temp.split(" "):
-                        line=line_temp
-                        entities["_entity_" + str(count) + "_"] = ki_text[2]
-
-                subject = " ".join(ki_text[0].split('_'))
-
-                if subject in line:
-                    count = count + 1
-                    line_temp = re.sub("(?![a-z]|[1-9])*"+subject, "_entity_" + str(count) + "_", line)
-                    line_temp = re.sub("_entity_[0-9]_[a-z|']{1,}", "_entity_" + str(count) + "_", line_temp)
-                    if "_entity_" + str(count) + "_" in line_temp.split(" "):
-                        line = line_temp
-                        entities["_entity_"+str(count)+"_"] = ki_text[0]
-
+            for ent_text, ent_label in doc_ents:
+                temp=(ent_text.strip()).split(" ")
+                if len(temp)>1 and ((ent_label == 'TIME' and len(temp)< 3) or ent_label == 'GPE'):
+                    line = line.replace(ent_text.lower(),'_'.join(temp).lower())
+            if entityMatcher is None:
+                entityMatcher = EntityMatcher(self, triples)
+            line, entities = entityMatcher.substitute(line)
 
             # Now to replace 50-60 by low and high degrees
-            p = re.compile("\\b(\d{2} - \d{2,3}(f| degrees|s)+)\\b")
-            x = p.findall(line)
+            x = DEGREES_PATTERN.findall(line)
             for degrees in x:
                 low = "low_of_" + degrees[0].split("-")[0].strip() + "_f"
                 high = "high_of_" + degrees[0].split("-")[1].strip()
@@ -889,47 +1058,91 @@ class TextData:
 
             return sentences
 
-    def load_embedding_from_disks(self, glove_filename, with_indexes=False):
+    def load_embedding_from_disks(self, glove_filename, with_indexes=False, words=None):
         """
         Read a GloVe txt file. If `with_indexes=True`, we return a tuple of two dictionnaries
         `(word_to_index_dict, index_to_embedding_array)`, otherwise we return only a direct
         `word_to_embedding_dict` dictionnary mapping from a string to a numpy array.
+        The text file is only parsed once, into a memory mapped binary copy (see EmbeddingStore). If `words` is given,
+        only the vectors of these words are read.
         """
+        store = EmbeddingStore(glove_filename)
+        if words is None:
+            words = store.words()
+        words = list(collections.OrderedDict.fromkeys(words))  # Unique, in order
+        vectors, found = store.gather(words)
+        words = [word for word, isFound in zip(words, found) if isFound]
+        vectors = vectors[found]
+
+        _WORD_NOT_FOUND = np.random.uniform(low=0.001, high=1.3, size=(store.dim,))   # random representation for unknown words.
         if with_indexes:
-            word_to_index_dict = dict()
-            index_to_embedding_array = []
-        else:
-            word_to_embedding_dict = dict()
-
-        with open(glove_filename, 'r') as glove_file:
-            for (i, line) in enumerate(glove_file):
-
-                split = line.strip().split(' ')
-
-                word = split[0]
-
-                representation = split[1:]
-
-                representation = np.array(
-                    [float(val) for val in representation]
-                )
-
-                if with_indexes:
-                    word_to_index_dict[word] = i
-                    index_to_embedding_array.append(representation)
-                else:
-                    word_to_embedding_dict[word] = representation
-
-        _WORD_NOT_FOUND = np.random.uniform(low=0.001, high=1.3, size=(len(representation),))   # random representation for unknown words.
-        if with_indexes:
-            _LAST_INDEX = i + 1
+            word_to_index_dict = {word: i for i, word in enumerate(words)}
+            _LAST_INDEX = len(words)
             word_to_index_dict = defaultdict(lambda: _LAST_INDEX, word_to_index_dict)
-            index_to_embedding_array = np.array(index_to_embedding_array + [_WORD_NOT_FOUND])
+            index_to_embedding_array = np.vstack([vectors, _WORD_NOT_FOUND[np.newaxis]])
             return word_to_index_dict, index_to_embedding_array
         else:
-            word_to_embedding_dict = defaultdict(lambda: _WORD_NOT_FOUND, word_to_embedding_dict)
+            word_to_embedding_dict = defaultdict(lambda: _WORD_NOT_FOUND, zip(words, vectors))
             return word_to_embedding_dict
 
+    def buildEmbeddingMatrix(self, embeddingFile, splitCompounds=False):
+        """Build the pretrained embedding matrix of the vocabulary
+        Every word id is resolved into rows of the embedding store first, then the matrix is built with a single
+        gather and a segment sum. A word missing from the store gets the same random vector as in
+        load_embedding_from_disks. With splitCompounds, a '_'-joined word gets (its own vector + the vectors of
+        its parts) / number of parts.
+        Args:
+            embeddingFile (str): the embedding text file (see EmbeddingStore)
+            splitCompounds (bool): compose the '_'-joined words from their parts
+        Return:
+            np.array<float32>: the (vocabularySize, dim) matrix
+            dict<str, int>: hit/miss/compound coverage counts
+        """
+        store = EmbeddingStore(embeddingFile)
+        vocabulary = [self.id2word[i] for i in range(self.getVocabularySize())]
+
+        # Segments: each word id is the sum of the vectors of its segment, divided by its divisor
+        segmentWords = []
+        segmentLengths = np.ones(len(vocabulary), dtype=np.int64)
+        divisors = np.ones(len(vocabulary), dtype=np.float32)
+        compounds = np.zeros(len(vocabulary), dtype=bool)
+        for i, word in enumerate(vocabulary):
+            segmentWords.append(word)
+            parts = word.split("_")
+            if splitCompounds and len(parts) > 1:
+                segmentWords.extend(parts)
+                segmentLengths[i] += len(parts)
+                divisors[i] = len(parts)
+                compounds[i] = True
+
+        uniqueWords, segmentIds = np.unique(np.array(segmentWords, dtype=str), return_inverse=True)
+        vectors, found = store.gather(list(uniqueWords))
+        _WORD_NOT_FOUND = np.random.uniform(low=0.001, high=1.3, size=(store.dim,))   # random representation for unknown words.
+        vectors[~found] = _WORD_NOT_FOUND
+
+        starts = np.concatenate([[0], np.cumsum(segmentLengths)[:-1]])
+        emb_matrix = np.add.reduceat(vectors[segmentIds.reshape(-1)], starts, axis=0) / divisors[:, np.newaxis]
+
+        # Coverage statistics
+        wordFound = found[segmentIds.reshape(-1)[starts]]
+        partFound = found[segmentIds.reshape(-1)]
+        partFound[starts] = True  # Only keep the parts
+        partsPerWord = np.add.reduceat(partFound.astype(np.int64), starts) - 1
+        stats = {
+            'vocabulary': len(vocabulary),
+            'hits': int(wordFound.sum()),
+            'misses': int((~wordFound).sum()),
+            'compounds': int(compounds.sum()),
+            'compoundsFullyCovered': int((compounds & (partsPerWord == segmentLengths - 1)).sum()),
+            'compoundParts': int((segmentLengths - 1).sum()),
+            'compoundPartsFound': int(partsPerWord.sum()),
+        }
+        print('Embedding coverage: {hits}/{vocabulary} words found, {misses} missing, '
+              '{compoundsFullyCovered}/{compounds} compounds fully covered '
+              '({compoundPartsFound}/{compoundParts} parts found)'.format(**stats))
+
+        return emb_matrix.astype(np.float32), stats
+
     def getWordId(self, word, create=True):
         """Get the id of the word (and add it to the dictionary if not existing). If the word does not exist and
         create is set to False, the function will return the unknownToken value
@@ -991,19 +1204,30 @@ class TextData:
         if not clean:
             return ' '.join([self.id2word[idx] for idx in sequence])
 
-        sentence = []
-        for wordId in sequence:
-            if wordId == self.eosToken:  # End of generated sentence
-                sentence.append(self.id2word[wordId])
-                break
-            elif wordId != self.padToken and wordId != self.goToken and wordId != self.eouToken:
-                sentence.append(self.id2word[wordId])
+        sentence = [self.id2word[wordId] for wordId in self.cleanSequence(sequence)]
 
         if reverse:  # Reverse means input so no <eos> (otherwise pb with previous early stop)
             sentence.reverse()
 
         return self.detokenize(sentence)
 
+    def cleanSequence(self, sequence):
+        """Remove the <go>, <pad> and <eou> tokens, and everything after the first <eos> (kept)
+        Args:
+            sequence (list<int>): the word ids
+        Return:
+            list<int>: the word ids sequence2str(clean=True) prints
+        """
+        cleaned = []
+        for wordId in sequence:
+            wordId = int(wordId)
+            if wordId == self.eosToken:  # End of generated sentence
+                cleaned.append(wordId)
+                break
+            elif wordId != self.padToken and wordId != self.goToken and wordId != self.eouToken:
+                cleaned.append(wordId)
+        return cleaned
+
     def sentence2sequence(self, sentence):
         list = sentence.split(' ')
         sequence=[]
@@ -1088,15 +1312,24 @@ class TextData:
         pass
 
     def getInputMaxLength(self):
-        maxT=max(map(len, (s for [s, _,_,_] in self.trainingSamples)))
+        maxT = int(self.trainingSamples.encoderLengths().max())
         return maxT
 
     def getTargetMaxLength(self):
-        maxT = max(map(len, (s for [_, s,_,_] in self.trainingSamples)))
+        maxT = int(self.trainingSamples.decoderLengths().max())
         return maxT+2
 
     def getMaxTriples(self):
-        return max(map(len, (s for [_, _,s,_] in self.trainingSamples)))
+        return int(self.trainingSamples.kbSizes().max())
+
+    def getTargetWordCounts(self):
+        """Count the words the decoder has to predict on the training set (idCount is cleared by the filtering)
+        Return:
+            np.array<int>: the number of occurrences of each word id in the targets, <eos> included (one per target)
+        """
+        counts = np.bincount(self.trainingSamples.decoder, minlength=self.getVocabularySize())
+        counts[self.eosToken] += len(self.trainingSamples)
+        return counts
 
 def tqdm_wrap(iterable, *args, **kwargs):
     """Forward an iterable eventually wrapped around a tqdm decorator
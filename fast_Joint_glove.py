@@ -13,6 +13,7 @@ from tqdm import tqdm
 import nltk
 import hypertools as hyp
 import spacy
+from corpus.datasetcache import DatasetCache
 
 nlp = spacy.load('en_core_web_sm')
 # Hyperparameters
@@ -47,18 +48,39 @@ class WordIndexer:
         self.min_word_occurences = min_word_occurences
         self.word_occurrences = {}
         self.entity_occurrences = {}
-        self.loadDataset("data/samples/dataset-kvret.pkl")
+        self.loadDataset("data/samples/dataset-kvret")
         #self.re_words = nltk.word_tokenize() #re.compile(r"\b[a-zA-Z1-9]{1,}\b")
 
     def loadDataset(self, filename):
-        """Load samples from file
+        """Load samples from the dataset cache written by TextData, or from the pickle of the previous versions
+        (<filename>.pkl) when there is no cache yet
+        Args:
+            filename (str): cache directory
+        """
+        cache = DatasetCache(filename, [], {})
+        if not cache.exists() and os.path.isfile(filename + '.pkl'):
+            self.loadLegacyDataset(filename + '.pkl')
+            return
+        print('Loading dataset from {}'.format(filename))
+        metadata, splits = cache.load()
+        self.word_to_index = {word: wordId for wordId, word in metadata['id2word']}
+        self.index_to_word = {wordId: word for wordId, word in metadata['id2word']}
+        self.intent2id = {intent: intentId for intentId, intent in metadata['id2intent']}
+        self.id2intent = {intentId: intent for intentId, intent in metadata['id2intent']}
+        self.idCount = dict(metadata['idCount']) if metadata['idCount'] is not None else None
+        self.trainingSamples = splits['trainingSamples']
+        self.validationSamples = splits['validationSamples']
+        self.testSamples = splits['testSamples']
+        self.unknownToken = self.word_to_index['<unknown>']  # Restore special words
+
+    def loadLegacyDataset(self, filename):
+        """Load samples from the pickle written by the previous versions
         Args:
             filename (str): pickle filename
         """
-        dataset_path = os.path.join(filename)
-        print('Loading dataset from {}'.format(dataset_path))
-        with open(dataset_path, 'rb') as handle:
-            data = pickle.load(handle)  # Warning: If adding something here, also modifying saveDataset
+        print('Loading dataset from {}'.format(filename))
+        with open(filename, 'rb') as handle:
+            data = pickle.load(handle)
             self.word_to_index = data['word2id']
             self.index_to_word = data['id2word']
             self.intent2id=data['intent2id']
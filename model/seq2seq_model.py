@@ -11,11 +11,11 @@ import torch.nn as nn
 from torch.autograd import Variable
 from torch import optim
 import torch.nn.functional as F
-from util.utils import masked_cross_entropy, compute_ent_loss
+from util.utils import masked_cross_entropy, EntityLoss
 import os
 
-from util.measures import moses_multi_bleu
-import nltk
+from util.measures import MetricsAccumulator
+from util.metrics import EmbeddingMetrics, EntityMetrics
 
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
@@ -24,6 +24,219 @@ import numpy as np
 hostname = socket.gethostname()
 
 
+def sequence_lengths(input_mask, input_lengths=None):
+    """
+    Lengths of the (right padded) input sequences, as expected by pack_padded_sequence
+    :param input_mask: S X B
+    :param input_lengths: B, the lengths if already known (list, array or tensor)
+    :return: B, CPU LongTensor (at least 1)
+    """
+    if input_lengths is None:
+        input_lengths = input_mask.sum(0)
+    return torch.as_tensor(input_lengths).long().cpu().clamp(min=1)
+
+
+def accumulate_gradients(model, loss, target_mask, sample_loss=None, n_samples=0, step=True):
+    """
+    Backward pass of a (micro-)batch, weighted by its number of target tokens
+    :param model: model with accumulated_tokens, accumulated_samples and sample_grads
+    :param loss: mean loss per target token of the batch
+    :param target_mask: the target tokens mask of the batch
+    :param sample_loss: mean loss per sample of the batch (e.g. the intent loss), weighted by its number of samples
+    :param n_samples: number of samples of the batch
+    :param step: if the optimizer step follows this batch
+    """
+    n_tokens = float(target_mask.sum())
+    if sample_loss is not None and (not step or model.accumulated_tokens > 0):
+        # Several batches: the gradients of the per sample loss are kept apart, to be averaged over all the samples
+        # in apply_gradients (else the samples with longer targets would weigh more)
+        params = [param for param in model.parameters() if param.requires_grad]
+        grads = torch.autograd.grad(sample_loss * n_samples, params, retain_graph=True, allow_unused=True)
+        for param, grad in zip(params, grads):
+            if grad is not None:
+                model.sample_grads[param] = grad + model.sample_grads[param] if param in model.sample_grads else grad
+        model.accumulated_samples += n_samples
+    elif sample_loss is not None:  # Single batch: both means in one backward pass
+        loss = loss + sample_loss
+    (loss * n_tokens).backward()
+    model.accumulated_tokens += n_tokens
+
+
+def apply_gradients(model):
+    """
+    Optimizer step with the gradients accumulated since the last step, averaged over all their target tokens (and
+    over all their samples for the per sample losses): N accumulated micro-batches give the update of one batch
+    holding all of them
+    :param model: model with optimizer, clip, accumulated_tokens, accumulated_samples and sample_grads
+    """
+    if model.accumulated_tokens == 0:
+        return
+    for param in model.parameters():
+        if param.grad is not None:
+            param.grad.div_(model.accumulated_tokens)
+        if param in model.sample_grads:
+            sample_grad = model.sample_grads[param] / model.accumulated_samples
+            param.grad = sample_grad if param.grad is None else param.grad.add_(sample_grad)
+
+    # clip gradient (one global norm over all the parameters)
+    torch.nn.utils.clip_grad_norm_(model.parameters(), model.clip)
+
+    # Update parameters
+    model.optimizer.step()
+    model.optimizer.zero_grad()
+    model.accumulated_tokens = 0
+    model.accumulated_samples = 0
+    model.sample_grads = {}
+
+
+def corpus_embedding_metrics(data):
+    """
+    Embedding metrics over the pretrained embedding of the corpus, None without one
+    :param data: TextData
+    """
+    if data.pretrained_emb is None:
+        return None
+    return EmbeddingMetrics(matrix=data.pretrained_emb.cpu().numpy())
+
+
+def corpus_entity_metrics(data):
+    """
+    Entity F1 and KB retrieval accuracy per intent of the corpus
+    :param data: TextData
+    """
+    return EntityMetrics(data.id2intent, data.entities_property.keys())
+
+
+def mixed_precision(precision, device):
+    """
+    Autocast context of the training precision
+    :param precision: 'fp32', or 'bf16' to run the matrix products (LSTMs, attention, projections) in bfloat16
+    :param device: the device of the model inputs
+    """
+    device_type = torch.device(device).type
+    return torch.autocast(device_type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+def build_optimizer(model, lr, decoder_learning_ratio):
+    """
+    Single Adam over all the model parameters, one group per learning rate
+    :param model: module with an encoder and a decoder
+    :param lr: learning rate of the encoder and of the other parameters (embedding, ...)
+    :param decoder_learning_ratio: the decoder learns at lr * decoder_learning_ratio
+    :return: the optimizer
+    """
+    decoder_params = list(model.decoder.parameters())
+    decoder_ids = {id(p) for p in decoder_params}
+    other_params = [p for p in model.parameters() if id(p) not in decoder_ids]
+    return optim.Adam([{'params': other_params, 'lr': lr},
+                       {'params': decoder_params, 'lr': lr * decoder_learning_ratio}], lr=lr)
+
+
+def frequency_cutoffs(sorted_counts, coverage=(0.8, 0.95)):
+    """
+    Cluster boundaries of an adaptive softmax: the head holds the most frequent words covering coverage[0] of the
+    tokens, the next cluster the words up to coverage[1], and so on
+    :param sorted_counts: V, word counts sorted in decreasing order
+    :param coverage: the share of the tokens covered by the head and by each cluster
+    :return: list of increasing ranks, each in [1, V - 1]
+    """
+    sorted_counts = torch.as_tensor(sorted_counts, dtype=torch.double)
+    vocab_size = sorted_counts.size(0)
+    cumulative = torch.cumsum(sorted_counts, 0) / sorted_counts.sum().clamp(min=1)
+    cutoffs = sorted({int((cumulative < share).sum()) + 1 for share in coverage})
+    cutoffs = [cutoff for cutoff in cutoffs if cutoff < vocab_size - 1]
+    return cutoffs or [max(vocab_size // 2, 1)]
+
+
+class AdaptiveOutput(nn.Module):
+    """
+    Adaptive softmax output layer, used instead of the full vocabulary projection: the frequent words are scored by a
+    small head, the rare ones by smaller clusters which are only evaluated for the targets falling into them.
+    The word ids aren't sorted by frequency, so they are mapped to their frequency rank first.
+    Called like the nn.Linear it replaces, it returns the full log probabilities (for evaluation and decoding).
+    """
+    def __init__(self, hidden_size, word_counts, cutoffs=None, div_value=4.0):
+        """
+        :param word_counts: V, number of occurrences of each word id (e.g. TextData.getTargetWordCounts())
+        :param cutoffs: the rank boundaries of the clusters (default: from the word frequencies, see frequency_cutoffs)
+        """
+        super(AdaptiveOutput, self).__init__()
+        counts = torch.as_tensor(np.asarray(word_counts), dtype=torch.double)
+        order = torch.argsort(counts, descending=True, stable=True)  # rank -> word id
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(order.size(0))  # word id -> rank
+        self.register_buffer('order', order)
+        self.register_buffer('rank', rank)
+        if cutoffs is None:
+            cutoffs = frequency_cutoffs(counts[order])
+        self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(hidden_size, order.size(0), cutoffs, div_value=div_value)
+
+    @staticmethod
+    def full_precision(features):
+        """
+        Autocast disabled: nn.AdaptiveLogSoftmaxWithLoss copies the cluster outputs into float32 buffers, which fails
+        on the bfloat16 outputs of its linear layers under autocast
+        """
+        return torch.autocast(features.device.type, enabled=False)
+
+    def forward(self, features):
+        """
+        :param features: ... X H
+        :return: ... X V log probabilities, in word id order
+        """
+        with self.full_precision(features):
+            log_probs = self.adaptive.log_prob(features.float().reshape(-1, features.size(-1)))
+        return log_probs.index_select(1, self.rank).view(*features.shape[:-1], -1)
+
+    def predict(self, features):
+        """
+        :param features: ... X H
+        :return: ... the most likely word ids (the rare clusters are only evaluated where the head points to them)
+        """
+        with self.full_precision(features):
+            predictions = self.adaptive.predict(features.float().reshape(-1, features.size(-1)))
+        return self.order[predictions].view(features.shape[:-1])
+
+    def loss(self, features, target, mask):
+        """
+        Masked negative log likelihood, normalized like masked_cross_entropy
+        :param features: B X S X H
+        :param target: B X S
+        :param mask: B X S
+        """
+        mask = mask.reshape(-1)
+        selected = mask > 0  # Only the real target words are scored
+        with self.full_precision(features):
+            target_log_probs = self.adaptive(features.float().reshape(-1, features.size(-1))[selected],
+                                             self.rank[target.reshape(-1)[selected].long()]).output
+        return -(target_log_probs * mask[selected]).sum() / (mask.float().sum() + 1e-8)
+
+
+def output_loss(out, outputs, target, target_mask):
+    """
+    Masked cross entropy of the decoder outputs
+    :param out: the output layer of the decoder
+    :param outputs: S X B X V logits, or S X B X H features when out is an AdaptiveOutput
+    :param target: S X B
+    :param target_mask: B X S
+    """
+    if isinstance(out, AdaptiveOutput):
+        return out.loss(outputs.transpose(0, 1), target.transpose(0, 1), target_mask)
+    return masked_cross_entropy(outputs.transpose(0, 1).contiguous(),  # -> B x S X VOCAB
+                                target.transpose(0, 1).contiguous(),  # -> B x S
+                                target_mask)
+
+
+def output_predictions(out, outputs):
+    """
+    :param outputs: S X B X V logits, or S X B X H features when out is an AdaptiveOutput
+    :return: S X B the predicted words
+    """
+    if isinstance(out, AdaptiveOutput):
+        return out.predict(outputs)
+    return outputs.argmax(-1)
+
+
 class LuongEncoderRNN(nn.Module):
     def __init__(self, input_size, hidden_size, emb_dim, b_size, n_layers=1, dropout=0.1, gpu=False):
         super(LuongEncoderRNN, self).__init__()
@@ -50,9 +263,14 @@ class LuongEncoderRNN(nn.Module):
 
     def forward(self, embedded, input_lengths, hidden=None):
         hidden = self.init_weights(embedded.size(1))
-        #packed = torch.nn.utils.rnn.pack_padded_sequence(embedded, input_lengths)
-        output, hidden = self.lstm(embedded, hidden)
-        #output, _ = torch.nn.utils.rnn.pad_packed_sequence(output)  # unpack (back to padded)
+        if input_lengths is None:
+            output, hidden = self.lstm(embedded, hidden)
+            return output, hidden
+
+        # Only the words go through the LSTM (pack sorts the sequences by length, the outputs come back unsorted)
+        packed = torch.nn.utils.rnn.pack_padded_sequence(embedded, input_lengths, enforce_sorted=False)
+        output, hidden = self.lstm(packed, hidden)
+        output, _ = torch.nn.utils.rnn.pad_packed_sequence(output, total_length=embedded.size(0))  # unpack (back to padded)
         return output, hidden
 
 class EncoderRNN(nn.Module):
@@ -95,11 +313,11 @@ class EncoderRNN(nn.Module):
         hidden = self.init_weights(inp_emb.size(1))
 
         if input_lengths is not None:
-            embedded = nn.utils.rnn.pack_padded_sequence(embedded, input_lengths)
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, input_lengths, enforce_sorted=False)
 
         outputs, hidden = self.rnn(embedded, hidden)  # outputs = S X B X n_layers*H, hidden = 2 * [1 X B X H]
         if input_lengths is not None:
-            outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs)
+            outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, total_length=inp_emb.size(0))
         return outputs, hidden
 
 
@@ -178,10 +396,32 @@ class Attention(nn.Module):
 
         return a, context
 
+    def forward_sequence(self, encoder_outputs, decoder_states, inp_mask):
+        """
+        Attention of all the decoder steps at once, same result as calling forward at each step
+        :param encoder_outputs: B X S X H
+        :param decoder_states: T X B X H, the (last layer) decoder hidden state of each step
+        :param inp_mask: S X B
+        :return: the context vectors, T X B X H
+        """
+        hidden_size = decoder_states.size(2)
+        # W_h([s; e]) = W_s s + W_e e: the encoder side is projected once for all the steps
+        W_s, W_e = self.W_h.weight[:, :hidden_size], self.W_h.weight[:, hidden_size:]
+        enc_proj = F.linear(encoder_outputs, W_e)  # B X S X H
+        dec_proj = F.linear(decoder_states, W_s)  # T X B X H
+        energy = torch.tanh(dec_proj.unsqueeze(2) + enc_proj.unsqueeze(0))  # T X B X S X H
+        energy = torch.matmul(energy, self.v)  # T X B X S
+
+        a = F.softmax(energy, dim=1) * inp_mask.transpose(0, 1)  # softmax over the batch, as in forward
+        a = a / (a.sum(2, keepdim=True) + self.epsilon)
+        context = torch.bmm(a.transpose(0, 1), encoder_outputs)  # B X T X H
+
+        return context.transpose(0, 1)
+
 
 class LuongAttnDecoderRNN(nn.Module):
     def __init__(self, attn_model, hidden_size, emb_dim, output_size, batch_size, n_layers=1, dropout=0.1, intent_size=3, emb=None,
-                 use_cuda=None):
+                 use_cuda=None, word_counts=None):
         super(LuongAttnDecoderRNN, self).__init__()
 
         # Keep for reference
@@ -198,7 +438,9 @@ class LuongAttnDecoderRNN(nn.Module):
         self.lstm_intent = nn.LSTM(intent_size, hidden_size)
 
         self.concat = nn.Linear(hidden_size * 2, hidden_size)
-        self.out = nn.Linear(hidden_size, output_size)
+        # Adaptive softmax when the word counts are given, else the full vocabulary projection
+        self.adaptive = word_counts is not None
+        self.out = AdaptiveOutput(hidden_size, word_counts) if self.adaptive else nn.Linear(hidden_size, output_size)
         self.intent_out = nn.Linear(self.hidden_size , self.intent_size)
 
         # Choose attention model
@@ -207,11 +449,13 @@ class LuongAttnDecoderRNN(nn.Module):
             self.intent_attn = Attn(attn_model, hidden_size, self.use_cuda) #Attn(attn_model, hidden_size, use_cuda)
             self.attention = Attention(hidden_size)
 
-    def forward(self, embedded, last_context, last_hidden, encoder_outputs, inp_mask, intent_batch=False, Kb_batch=False):
+    def forward(self, embedded, last_context, last_hidden, encoder_outputs, inp_mask, intent_batch=False, Kb_batch=False,
+                project=True):
         # Note: we run this one step at a time (in order to do teacher forcing)
+        # project=False returns the features given to the output layer instead of the vocabulary scores
 
         # Get the embedding of the current input word (last output word)
-        batch_size = self.batch_size
+        batch_size = last_hidden[0].size(1)  # The batches don't all have self.batch_size samples
         #         print('[decoder] input_seq', input_seq.size()) # batch_size x 1
 
 
@@ -259,7 +503,7 @@ class LuongAttnDecoderRNN(nn.Module):
         concat_output = torch.tanh(self.concat(concat_input))
 
         # Finally predict next token (Luong eq. 6, without softmax)
-        output = self.out(concat_output)
+        output = self.out(concat_output) if project else concat_output
         # Return final output, hidden state, and attention weights (for visualization)
         return output, context, hidden, alpha, intent_score
 
@@ -299,7 +543,7 @@ class Decoder(nn.Module):
     """
     Decoder RNN
     """
-    def __init__(self, hidden_size, emb_dim, vocab_size, n_layers=1, dropout=0.0):
+    def __init__(self, hidden_size, emb_dim, vocab_size, n_layers=1, dropout=0.0, word_counts=None):
         super(Decoder, self).__init__()
         self.hidden_size = hidden_size
         self.emb_dim = emb_dim
@@ -312,14 +556,17 @@ class Decoder(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.rnn = nn.LSTM(emb_dim, hidden_size, n_layers, dropout=dropout)
         #self.rnn = rnn
-        self.out = nn.Linear(hidden_size, vocab_size)
+        # Adaptive softmax when the word counts are given, else the full vocabulary projection
+        self.adaptive = word_counts is not None
+        self.out = AdaptiveOutput(hidden_size, word_counts) if self.adaptive else nn.Linear(hidden_size, vocab_size)
         self.concat = nn.Linear(hidden_size * 2, hidden_size)
 
         # Attention
         self.attention = Attention(hidden_size)
 
-    def forward(self, inp_emb, last_hidden, encoder_outputs, inp_mask):
+    def forward(self, inp_emb, last_hidden, encoder_outputs, inp_mask, project=True):
         # Note: we run this one step at a time
+        # project=False returns the features given to the output layer instead of the vocabulary scores
 
         # Get the embedding of the current input word (last output word)
 
@@ -347,10 +594,88 @@ class Decoder(nn.Module):
         concat_output = torch.tanh(self.concat(concat_input))
 
         # Finally predict next token (Luong eq. 6, without softmax)
-        output = self.out(concat_output)
+        output = self.out(concat_output) if project else concat_output
         # Return final output, hidden state, and attention weights (for visualization)
         return output, hidden
 
+    def forward_sequence(self, inp_emb, last_hidden, encoder_outputs, inp_mask, project=True):
+        """
+        Teacher forced decoding of the whole sequence: one LSTM call, the attention of all the steps at once and a
+        single vocabulary projection. Same result as calling forward step by step with the gold previous words.
+        :param inp_emb: T X B X E, embedded decoder inputs (<go> then the targets shifted right)
+        :param last_hidden: initial hidden state
+        :param encoder_outputs: S X B X H
+        :param inp_mask: S X B
+        :param project: if False, return the T X B X H features given to the output layer
+        :return: output T X B X V, last hidden state
+        """
+        embedded = self.dropout(inp_emb)
+        rnn_output, hidden = self.rnn(embedded, last_hidden)  # T X B X H, also the last layer state of each step
+
+        context = self.attention.forward_sequence(encoder_outputs.transpose(0, 1), rnn_output, inp_mask)
+
+        concat_output = torch.tanh(self.concat(torch.cat((rnn_output, context), 2)))
+        output = self.out(concat_output) if project else concat_output
+        return output, hidden
+
+
+def beam_search_decode(step, state, reorder, b_size, beam_size, sos_tok, eos_tok, max_length, length_penalty=1.0,
+                       constrain=None, device=None):
+    """
+    Beam search with the beams folded into the batch dimension: row i * beam_size + k is the k-th hypothesis of the
+    i-th sample. A finished hypothesis is only extended with <eos> (at no cost), and the decoding stops as soon as
+    every hypothesis is finished.
+    :param step: function(words (B*K), state, t) -> (logits B*K X V, new state)
+    :param state: initial decoder state, already repeated beam_size times
+    :param reorder: function(state, index) -> state, selecting the rows of index (B*K)
+    :param constrain: optional function(words (B*K)) -> words, applied to the chosen words (e.g. KB entities)
+    :param length_penalty: the final scores are the log probabilities divided by length ** length_penalty
+    :return: decoded T X B (the best hypothesis of each sample), scores B
+    """
+    K = beam_size
+    scores = torch.full((b_size, K), float('-inf'), device=device)
+    scores[:, 0] = 0  # All the beams start with the same <go>, only one is kept at the first step
+    words = torch.full((b_size * K,), sos_tok, dtype=torch.long, device=device)
+    finished = torch.zeros(b_size, K, dtype=torch.bool, device=device)
+    lengths = torch.zeros(b_size, K, dtype=torch.long, device=device)
+    offsets = (torch.arange(b_size, device=device) * K).unsqueeze(1)
+    history = []  # Chosen words and beam of origin of each step
+    eos_only = None
+
+    for t in range(max_length):
+        logits, state = step(words, state, t)
+        log_probs = F.log_softmax(logits.float(), dim=1).view(b_size, K, -1)
+        if eos_only is None:
+            eos_only = torch.full((log_probs.size(2),), float('-inf'), device=device)
+            eos_only[eos_tok] = 0
+        log_probs = torch.where(finished.unsqueeze(2), eos_only, log_probs)
+
+        scores, flat = (scores.unsqueeze(2) + log_probs).view(b_size, -1).topk(K, dim=1)
+        origin = flat // log_probs.size(2)
+        words = (flat % log_probs.size(2)).view(-1)
+        if constrain is not None:
+            words = constrain(words)
+
+        finished = finished.gather(1, origin)
+        lengths = lengths.gather(1, origin) + (~finished).long()
+        finished = finished | (words.view(b_size, K) == eos_tok)
+        state = reorder(state, (origin + offsets).view(-1))
+        history.append((words.view(b_size, K), origin))
+
+        if finished.all():
+            break
+
+    scores = scores / lengths.clamp(min=1).float() ** length_penalty
+    beam = scores.argmax(1)
+    best_scores = scores.gather(1, beam.unsqueeze(1)).squeeze(1)
+
+    decoded = torch.zeros(len(history), b_size, dtype=torch.long, device=device)
+    for t in reversed(range(len(history))):  # Follow the best hypotheses back
+        step_words, origin = history[t]
+        decoded[t] = step_words.gather(1, beam.unsqueeze(1)).squeeze(1)
+        beam = origin.gather(1, beam.unsqueeze(1)).squeeze(1)
+    return decoded, best_scores
+
 
 class Seq2SeqmitAttn(nn.Module):
     """
@@ -360,7 +685,8 @@ class Seq2SeqmitAttn(nn.Module):
     def __init__(self, hidden_size, max_r, n_words, b_size, emb_dim, sos_tok, eos_tok, itos, gpu=False, lr=0.01,
                  train_emb=True,
                  n_layers=1, clip=2.0, pretrained_emb=None, dropout=0.0, emb_drop=0.0, teacher_forcing_ratio=0.0,
-                 use_entity_loss = False, entities_property=None):
+                 use_entity_loss = False, entities_property=None, fused_teacher_forcing=True, word_counts=None,
+                 precision='fp32'):
         super(Seq2SeqmitAttn, self).__init__()
         self.name = "VanillaSeq2Seq"
         self.input_size = n_words
@@ -381,7 +707,11 @@ class Seq2SeqmitAttn(nn.Module):
         self.clip = clip
         self.use_cuda = gpu
         self.use_entity_loss=use_entity_loss
+        self.entity_criterion = EntityLoss()
         self.entities_p=entities_property
+        self.fused_teacher_forcing = fused_teacher_forcing  # Decode the gold targets in one call (else step by step)
+        self.precision = precision  # Training precision, 'fp32' or 'bf16' (see mixed_precision)
+        self.entity_property_table = None  # entities_p as a tensor (built on first use)
         # Common embedding for both encoder and decoder
         self.embedding = nn.Embedding(self.output_size, self.emb_dim, padding_idx=0)
         if pretrained_emb is not None:
@@ -394,7 +724,8 @@ class Seq2SeqmitAttn(nn.Module):
         # initializing the model
         self.encoder = EncoderRNN(self.n_layers, self.emb_dim, self.hidden_size, self.b_size, self.output_size,
                                   gpu=self.use_cuda)
-        self.decoder = Decoder(self.hidden_size, self.emb_dim, self.output_size)
+        # word_counts (training target counts of each word id) switch the decoder to an adaptive softmax output
+        self.decoder = Decoder(self.hidden_size, self.emb_dim, self.output_size, word_counts=word_counts)
 
         if self.use_cuda:
             self.encoder = self.encoder.cuda()
@@ -402,15 +733,21 @@ class Seq2SeqmitAttn(nn.Module):
             self.embedding = self.embedding.cuda()
             # self.rnn = self.rnn.cuda()
 
-        self.encoder_optimizer = optim.Adam(self.encoder.parameters(), lr=lr)
-        self.decoder_optimizer = optim.Adam(self.decoder.parameters(), lr=lr * self.decoder_learning_ratio)
-        self.optimizer = optim.Adam(self.parameters(), lr=lr)
+        self.optimizer = build_optimizer(self, lr, self.decoder_learning_ratio)
+        self.accumulated_tokens = 0  # Target tokens of the gradients accumulated since the last optimizer step
+        self.accumulated_samples = 0  # Samples of the per sample loss gradients (sample_grads) accumulated
+        self.sample_grads = {}
 
         self.loss = 0
+        self.eval_metrics = None  # MetricsAccumulator of the last evaluate_model
         self.print_every = 1
 
     def train_batch(self, input_batch, out_batch, input_mask, target_mask,
-                    input_length=None, output_length=None, target_kb_mask=None):
+                    input_length=None, output_length=None, target_kb_mask=None, step=True):
+        """
+        Forward and backward pass of a batch
+        :param step: if False, the gradients are accumulated and the optimizer step is deferred (see apply_gradients)
+        """
 
         self.encoder.train(True)
         self.decoder.train(True)
@@ -422,93 +759,90 @@ class Seq2SeqmitAttn(nn.Module):
             input_mask=input_mask.cuda()
             target_mask=target_mask.cuda()
             target_kb_mask = target_kb_mask.cuda()
-        inp_emb = self.embedding(input_batch)
-        # print (len(out_batch))
-        b_size = input_batch.size(1)
-        # print (b_size)
-        # Zero gradients of both optimizers
-        self.encoder_optimizer.zero_grad()
-        self.decoder_optimizer.zero_grad()
-        self.optimizer.zero_grad()
-
-        # Run words through encoder
-        encoder_outputs, encoder_hidden = self.encoder(inp_emb,input_length)
-
-        # target_len = torch.sum(target_mask, dim=0)
-        target_len = out_batch.size(0)
-        # print (min(max(target_len), self.max_r))
-        max_target_length = min(target_len, self.max_r)
-        # print (max_target_length)
-        if not isinstance(max_target_length, int):
-            max_target_length = int(max_target_length.cpu().numpy()) if self.use_cuda else int(
-                max_target_length.numpy())
-
-        # Prepare input and output variables
-        if self.use_cuda:
-            decoder_input = Variable(torch.Tensor([self.sos_tok] * b_size)).cuda().long()
-            all_decoder_outputs_vocab = Variable(torch.zeros(int(max_target_length), b_size, self.output_size)).cuda()
-        else:
-            decoder_input = Variable(torch.Tensor([self.sos_tok] * b_size)).long()
-            all_decoder_outputs_vocab = Variable(torch.zeros(int(max_target_length), b_size, self.output_size))
-
-        decoder_hidden = (encoder_hidden[0][:self.decoder.n_layers], encoder_hidden[1][:self.decoder.n_layers])
-        # print (decoder_input.type())
-        # print (decoder_input.size(), out_batch.size())
-        # Choose whether to use teacher forcing
-        use_teacher_forcing = random.random() < self.teacher_forcing_ratio
-        decoded_words = Variable(torch.zeros(int(max_target_length), b_size)).cuda() if self.use_cuda else \
-            Variable(torch.zeros(int(max_target_length), b_size))
-        # provide data to decoder
-        # if use_teacher_forcing:
-        if 1:
-            for t in range(max_target_length):
-                inp_emb_d = self.embedding(decoder_input)
-                decoder_vocab, decoder_hidden = self.decoder(inp_emb_d, decoder_hidden, encoder_outputs, input_mask)
-                all_decoder_outputs_vocab[t] = decoder_vocab
-                decoder_input = out_batch[t].long()  # Next input is current target
-
+        # Forward pass and losses (under autocast in bf16 precision, the losses are computed in float32)
+        with mixed_precision(self.precision, input_batch.device):
+            inp_emb = self.embedding(input_batch)
+            # print (len(out_batch))
+            b_size = input_batch.size(1)
+            # print (b_size)
+            # Zero gradients (unless they are being accumulated)
+            if self.accumulated_tokens == 0:
+                self.optimizer.zero_grad()
+
+            # Run words through encoder
+            encoder_outputs, encoder_hidden = self.encoder(inp_emb, sequence_lengths(input_mask, input_length))
+
+            # target_len = torch.sum(target_mask, dim=0)
+            target_len = out_batch.size(0)
+            # print (min(max(target_len), self.max_r))
+            max_target_length = min(target_len, self.max_r)
+            # print (max_target_length)
+            if not isinstance(max_target_length, int):
+                max_target_length = int(max_target_length.cpu().numpy()) if self.use_cuda else int(
+                    max_target_length.numpy())
+
+            # Prepare input and output variables
+            if self.use_cuda:
+                decoder_input = Variable(torch.Tensor([self.sos_tok] * b_size)).cuda().long()
+            else:
+                decoder_input = Variable(torch.Tensor([self.sos_tok] * b_size)).long()
+
+            decoder_hidden = (encoder_hidden[0][:self.decoder.n_layers], encoder_hidden[1][:self.decoder.n_layers])
+            # print (decoder_input.type())
+            # print (decoder_input.size(), out_batch.size())
+            # Choose whether to use teacher forcing
+            use_teacher_forcing = random.random() < self.teacher_forcing_ratio
+            # provide data to decoder
+            # if use_teacher_forcing:
+            # With an adaptive softmax, the decoder outputs are the features and the loss only scores the targets
+            project = not self.decoder.adaptive
+            if self.fused_teacher_forcing:
+                decoder_inputs = torch.cat([decoder_input.unsqueeze(0), out_batch[:max_target_length - 1].long()], 0)
+                all_decoder_outputs_vocab, decoder_hidden = self.decoder.forward_sequence(
+                    self.embedding(decoder_inputs), decoder_hidden, encoder_outputs, input_mask, project=project)
+            else:
+                all_decoder_outputs_vocab = torch.zeros(int(max_target_length), b_size,
+                                                        self.output_size if project else self.hidden_size,
+                                                        device=encoder_outputs.device)
+                for t in range(max_target_length):
+                    inp_emb_d = self.embedding(decoder_input)
+                    decoder_vocab, decoder_hidden = self.decoder(inp_emb_d, decoder_hidden, encoder_outputs, input_mask,
+                                                                 project=project)
+                    all_decoder_outputs_vocab[t] = decoder_vocab
+                    decoder_input = out_batch[t].long()  # Next input is current target
 
 
-        # print (all_decoder_outputs_vocab.size(), out_batch.size())
-        # out_batch = out_batch.transpose(0, 1).contiguous
-        target_mask = target_mask.transpose(0, 1).contiguous()
-        # print (all_decoder_outputs_vocab.size(), out_batch.size(), target_mask.size())
-        loss_Vocab = masked_cross_entropy(
-            all_decoder_outputs_vocab.transpose(0, 1).contiguous(),  # -> B x S X VOCAB
-            out_batch.transpose(0, 1).contiguous(),  # -> B x S
-            target_mask
-        )
-        loss = loss_Vocab
 
-        if self.use_entity_loss and target_kb_mask is not None:
-            entity_loss=compute_ent_loss(self.embedding,
-                                         all_decoder_outputs_vocab.contiguous(),
-                             out_batch.transpose(0,1).contiguous(),
-                             target_kb_mask.transpose(0,1).contiguous(),
-                             target_mask)
+            # print (all_decoder_outputs_vocab.size(), out_batch.size())
+            # out_batch = out_batch.transpose(0, 1).contiguous
+            target_mask = target_mask.transpose(0, 1).contiguous()
+            # print (all_decoder_outputs_vocab.size(), out_batch.size(), target_mask.size())
+            loss_Vocab = output_loss(self.decoder.out, all_decoder_outputs_vocab, out_batch, target_mask)
+            loss = loss_Vocab
 
-            loss = loss + entity_loss
-        loss.backward()
+            if self.use_entity_loss and target_kb_mask is not None:
+                entity_loss = self.entity_criterion(self.embedding, all_decoder_outputs_vocab, out_batch.transpose(0, 1),
+                                                    target_kb_mask.transpose(0, 1), target_mask,
+                                                    predict=lambda outputs: output_predictions(self.decoder.out, outputs))
 
-        # clip gradient
-        torch.nn.utils.clip_grad_norm_(self.encoder.parameters(), self.clip)
-        torch.nn.utils.clip_grad_norm_(self.decoder.parameters(), self.clip)
-        torch.nn.utils.clip_grad_norm_(self.parameters(), self.clip)
+                loss = loss + entity_loss
 
-        # Update parameters with optimizers
-        self.encoder_optimizer.step()
-        self.decoder_optimizer.step()
-        self.optimizer.step()
+        accumulate_gradients(self, loss, target_mask)
+        if step:
+            apply_gradients(self)
 
         self.loss += loss.item()
 
-    def evaluate_batch(self, input_batch, out_batch, input_mask, target_mask, target_kb_mask=None, kb=None):
+    def evaluate_batch(self, input_batch, out_batch, input_mask, target_mask, target_kb_mask=None, kb=None,
+                       kb_tensor=None):
         """
         evaluating batch
         :param input_batch:
         :param out_batch:
         :param input_mask:
         :param target_mask:
+        :param kb: list of the KB triples of each sample (used if kb_tensor isn't given)
+        :param kb_tensor: B X M X 3 KB triples, padded with -1
         :return:
         """
         # Set to not-training mode to disable dropout
@@ -525,7 +859,7 @@ class Seq2SeqmitAttn(nn.Module):
         inp_emb = self.embedding(input_batch)
         # output decoder words
 
-        encoder_outputs, encoder_hidden = self.encoder(inp_emb)
+        encoder_outputs, encoder_hidden = self.encoder(inp_emb, sequence_lengths(input_mask))
         b_size = inp_emb.size(1)
         # target_len = torch.sum(target_mask, dim=0)
         target_len = out_batch.size(0)
@@ -548,6 +882,11 @@ class Seq2SeqmitAttn(nn.Module):
             Variable(torch.zeros(int(max_target_length), b_size))
         decoder_hidden = (encoder_hidden[0][:self.decoder.n_layers], encoder_hidden[1][:self.decoder.n_layers])
 
+        if kb_tensor is None and kb is not None:
+            kb_tensor = self.pad_kb(kb)
+        if kb_tensor is not None:
+            kb_tensor = kb_tensor.to(inp_emb.device)
+
         # provide data to decoder
         for t in range(max_target_length):
             # print (decoder_input)
@@ -559,8 +898,8 @@ class Seq2SeqmitAttn(nn.Module):
             all_decoder_outputs_vocab[t] = decoder_vocab
             topv, topi = decoder_vocab.data.topk(1)  # get prediction from decoder
 
-            for i in range(self.b_size):
-                topi[i] = self.check_entity(topi[i].item(), kb[i])
+            if kb_tensor is not None:
+                topi = self.check_entities(topi.view(-1), kb_tensor)
             decoder_input = Variable(topi.view(-1))  # use this in the next time-steps
             decoded_words[t] = (topi.view(-1))
 
@@ -580,60 +919,198 @@ class Seq2SeqmitAttn(nn.Module):
 
         return decoded_words, loss_Vocab.item()
 
-    def evaluate_model(self, data, valid=False, test=False):
+    def beam_search(self, input_batch, input_mask, beam_size=5, max_length=None, length_penalty=1.0, kb=None,
+                    kb_tensor=None):
+        """
+        Beam search decoding (see beam_search_decode)
+        :param input_batch: S X B
+        :param input_mask: S X B
+        :param kb, kb_tensor: if given, the chosen words are corrected with check_entities
+        :return: decoded T X B, scores B
+        """
+        self.encoder.train(False)
+        self.decoder.train(False)
+        self.embedding.train(False)
 
-        if test:
-            batches = data.getTestingBatch(self.b_size)
-        elif valid:
-            batches = data.getBatches(self.b_size, valid=True, transpose=False)
-        else:
-            batches = data.getBatches(self.b_size, test=True, transpose=False)
+        if self.use_cuda:
+            input_batch = input_batch.cuda()
+            input_mask = input_mask.cuda()
 
-        all_predicted = []
-        target_batches = []
-        individual_metric = []
+        with torch.no_grad():
+            inp_emb = self.embedding(input_batch)
+            encoder_outputs, encoder_hidden = self.encoder(inp_emb, sequence_lengths(input_mask))
+            b_size = input_batch.size(1)
 
-        for batch in batches:
-            input_batch = Variable(torch.LongTensor(batch.encoderSeqs)).transpose(0, 1)
-            target_batch = Variable(torch.LongTensor(batch.targetSeqs)).transpose(0, 1)
-            input_batch_mask = Variable(torch.FloatTensor(batch.encoderMaskSeqs)).transpose(0, 1)
-            target_batch_mask = Variable(torch.FloatTensor(batch.decoderMaskSeqs)).transpose(0, 1)
-            target_kb_mask = Variable(torch.LongTensor(batch.targetKbMask)).transpose(0, 1)
-            kb = batch.kb_inputs
-            decoded_words, loss_Vocab = self.evaluate_batch(input_batch, target_batch, input_batch_mask,
-                                                            target_batch_mask,
-                                                            target_kb_mask=target_kb_mask, kb=kb)
+            # The encoder runs once, its outputs are shared by the beams of a sample
+            index = torch.arange(b_size, device=inp_emb.device).repeat_interleave(beam_size)
+            encoder_outputs = encoder_outputs[:, index]
+            input_mask = input_mask[:, index]
+            decoder_hidden = (encoder_hidden[0][:self.decoder.n_layers][:, index],
+                              encoder_hidden[1][:self.decoder.n_layers][:, index])
 
-            batch_predictions = decoded_words.transpose(0, 1)
+            if kb_tensor is None and kb is not None:
+                kb_tensor = self.pad_kb(kb)
+            constrain = None
+            if kb_tensor is not None:
+                kb_tensor = kb_tensor.to(inp_emb.device)[index]
+                constrain = lambda words: self.check_entities(words, kb_tensor)
+
+            def step(words, hidden, t):
+                return self.decoder(self.embedding(words), hidden, encoder_outputs, input_mask)
 
-            batch_metric_score = 0
-            for i, sen in enumerate(batch_predictions):
-                predicted = data.sequence2str(sen.cpu().numpy(), clean=True)
-                reference = data.sequence2str(batch.targetSeqs[i], clean=True)
-                batch_metric_score += nltk.translate.bleu_score.sentence_bleu([reference], predicted)
+            def reorder(hidden, index):
+                return hidden[0][:, index], hidden[1][:, index]
+
+            decoded, scores = beam_search_decode(step, decoder_hidden, reorder, b_size, beam_size, self.sos_tok,
+                                                 self.eos_tok, max_length or self.max_r, length_penalty,
+                                                 constrain=constrain, device=inp_emb.device)
+
+        self.encoder.train(True)
+        self.decoder.train(True)
+        self.embedding.train(True)
+        return decoded, scores
+
+    def predict(self, input_batch, input_mask, max_length=None, kb=None, kb_tensor=None):
+        """
+        Greedy decoding for inference. Unlike evaluate_batch (which scores the targets), the logits aren't kept and
+        the decoding stops as soon as every sequence has produced <eos>. The finished sequences are still fed
+        (the attention is normalized over the batch), their words are only hidden in the output.
+        :param input_batch: S X B
+        :param input_mask: S X B
+        :param kb, kb_tensor: if given, the predicted words are corrected with check_entities
+        :return: decoded T X B, padded with 0 after <eos> (T <= max_length)
+        """
+        self.encoder.train(False)
+        self.decoder.train(False)
+        self.embedding.train(False)
 
-            batch_metric_score = batch_metric_score / self.b_size
+        if self.use_cuda:
+            input_batch = input_batch.cuda()
+            input_mask = input_mask.cuda()
 
-            all_predicted.append(batch_predictions)
-            target_batches.append(batch.targetSeqs)
-            individual_metric.append(batch_metric_score)
+        with torch.no_grad():
+            inp_emb = self.embedding(input_batch)
+            encoder_outputs, encoder_hidden = self.encoder(inp_emb, sequence_lengths(input_mask))
+            b_size = input_batch.size(1)
+            decoder_hidden = (encoder_hidden[0][:self.decoder.n_layers], encoder_hidden[1][:self.decoder.n_layers])
+
+            if kb_tensor is None and kb is not None:
+                kb_tensor = self.pad_kb(kb)
+            if kb_tensor is not None:
+                kb_tensor = kb_tensor.to(inp_emb.device)
+
+            decoder_input = torch.full((b_size,), self.sos_tok, dtype=torch.long, device=inp_emb.device)
+            finished = torch.zeros(b_size, dtype=torch.bool, device=inp_emb.device)
+            decoded_words = []
+            for t in range(max_length or self.max_r):
+                decoder_vocab, decoder_hidden = self.decoder(self.embedding(decoder_input), decoder_hidden,
+                                                             encoder_outputs, input_mask)
+                decoder_input = decoder_vocab.topk(1)[1].view(-1)
+                if kb_tensor is not None:
+                    decoder_input = self.check_entities(decoder_input, kb_tensor)
+
+                decoded_words.append(decoder_input.masked_fill(finished, 0))
+                finished = finished | (decoder_input == self.eos_tok)
+                if finished.all():
+                    break
 
-        candidates, references = data.get_candidates(target_batches, all_predicted)
+        self.encoder.train(True)
+        self.decoder.train(True)
+        self.embedding.train(True)
+        return torch.stack(decoded_words)
 
-        global_metric_score = nltk.translate.bleu_score.corpus_bleu(references, candidates)
+    def evaluate_model(self, data, valid=False, test=False, beam_size=1, compute_loss=True):
+        """
+        Decode the valid/test set and compute the BLEU scores
+        :param beam_size: 1 for greedy decoding
+        :param compute_loss: if False, the sequences are only predicted (early exit, no logits kept) and the
+            returned loss is None
+        """
 
-        candidates2, references2 = data.get_candidates(target_batches, all_predicted, True)
+        if test:
+            batches = data.getTestingBatch(self.b_size)
+        elif valid:
+            batches = data.iterBatches(self.b_size, valid=True, pin=self.use_cuda)
+        else:
+            batches = data.iterBatches(self.b_size, test=True, pin=self.use_cuda)
 
-        moses_multi_bleu_score = moses_multi_bleu(candidates2, references2, True,
-                                                  os.path.join("trained_model", self.__class__.__name__))
+        # BLEU, WER and loss, accumulated batch by batch
+        metrics = MetricsAccumulator(data.cleanSequence, sequence2str=data.sequence2str,
+                                     directory=os.path.join("trained_model", self.__class__.__name__),
+                                     embedding_metrics=corpus_embedding_metrics(data),
+                                     entity_metrics=corpus_entity_metrics(data))
 
-        return global_metric_score, individual_metric, moses_multi_bleu_score, loss_Vocab/len(batches)
+        for batch in batches:
+            loss_Vocab = None
+            input_batch = batch.encoderTensor
+            target_batch = batch.targetTensor
+            input_batch_mask = batch.encoderMaskTensor
+            target_batch_mask = batch.decoderMaskTensor
+            target_kb_mask = batch.targetKbMaskTensor
+            kb = batch.kb_inputs
+            if compute_loss:
+                decoded_words, loss_Vocab = self.evaluate_batch(input_batch, target_batch, input_batch_mask,
+                                                                target_batch_mask,
+                                                                target_kb_mask=target_kb_mask, kb=kb,
+                                                                kb_tensor=batch.kbTensor)
+            elif beam_size == 1:
+                decoded_words = self.predict(input_batch, input_batch_mask,
+                                             max_length=min(target_batch.size(0), self.max_r),
+                                             kb_tensor=batch.kbTensor)
+            if beam_size > 1:  # The loss is still the greedy one
+                decoded_words, _ = self.beam_search(input_batch, input_batch_mask, beam_size,
+                                                    max_length=min(target_batch.size(0), self.max_r),
+                                                    kb_tensor=batch.kbTensor)
+
+            metrics.update(decoded_words.transpose(0, 1), batch.targetSeqs, loss_Vocab, kb=batch.kbArray,
+                           intents=batch.seqIntent)
+
+        global_metric_score, individual_metric, moses_multi_bleu_score, eval_loss = metrics.finalize()
+        self.eval_metrics = metrics  # The other metrics of the last evaluation (WER, embedding and entity metrics)
+        return global_metric_score, individual_metric, moses_multi_bleu_score, eval_loss
 
     def print_loss(self):
         print_loss_avg = self.loss / self.print_every
         self.print_every += 1
         return 'L:{:.2f}'.format(print_loss_avg)
 
+    def pad_kb(self, kb):
+        """
+        Pad the KB triples of each sample into a B X M X 3 tensor (padding = -1)
+        """
+        kb_tensor = torch.full((len(kb), max(max(len(triples) for triples in kb), 1), 3), -1, dtype=torch.long)
+        for i, triples in enumerate(kb):
+            if len(triples) > 0:
+                kb_tensor[i, :len(triples)] = torch.as_tensor(triples, dtype=torch.long)
+        return kb_tensor
+
+    def check_entities(self, words, kb_tensor):
+        """
+        Batched check_entity: a predicted entity which isn't in the sample KB is replaced by the object of the first
+        triple having the entity property as relation (only for KBs with more than one triple)
+        :param words: B, the predicted word ids
+        :param kb_tensor: B X M X 3, padded with -1
+        :return: B, the corrected words
+        """
+        if not self.entities_p:
+            return words
+        if self.entity_property_table is None or self.entity_property_table.device != words.device:
+            table = torch.full((self.output_size,), -1, dtype=torch.long)
+            for entity, prop in self.entities_p.items():
+                if entity < self.output_size:
+                    table[entity] = prop
+            self.entity_property_table = table.to(words.device)
+
+        prop = self.entity_property_table[words]  # B, -1 if not an entity
+        kb_size = (kb_tensor[:, :, 0] >= 0).sum(1)
+        in_kb = ((kb_tensor[:, :, 0] == words.unsqueeze(1)) | (kb_tensor[:, :, 2] == words.unsqueeze(1))).any(1)
+        same_relation = kb_tensor[:, :, 1] == prop.unsqueeze(1)  # B X M
+        first = same_relation.long().argmax(1)  # First matching triple
+        replacement = kb_tensor.gather(1, first.view(-1, 1, 1).expand(-1, 1, 3))[:, 0, 2]
+
+        replace = (prop >= 0) & (kb_size > 1) & ~in_kb & same_relation.any(1)
+        return torch.where(replace, replacement, words)
+
     def check_entity(self, word, kb):
 
         if word in self.entities_p.keys() and len(kb)>1:
@@ -655,7 +1132,7 @@ class Seq2SeqAttnmitIntent(nn.Module):
     def __init__(self,  attn_model, hidden_size, input_size, output_size, batch_size, sos_tok, eso_tok, n_layers=1,
                  dropout=0.1, intent_size=3, intent_loss_coff=0.9, lr=0.001, decoder_learning_ratio=5.0,
                  pretrained_emb=None, train_emb=False, clip=50.0, teacher_forcing_ratio=1, gpu=False,
-                 use_entity_loss=False):
+                 use_entity_loss=False, word_counts=None, precision='fp32'):
         super(Seq2SeqAttnmitIntent, self).__init__()
 
         self.name = "LuongSeq2Seq"
@@ -666,6 +1143,8 @@ class Seq2SeqAttnmitIntent(nn.Module):
         self.input_size = input_size
         self.output_size = output_size
         self.use_entity_loss=use_entity_loss
+        self.entity_criterion = EntityLoss()
+        self.precision = precision  # Training precision, 'fp32' or 'bf16' (see mixed_precision)
         self.emb_dim = hidden_size
         self.hidden_size = hidden_size
 
@@ -678,7 +1157,7 @@ class Seq2SeqAttnmitIntent(nn.Module):
         self.teacher_forcing_ratio = teacher_forcing_ratio
 
         self.sos_tok = sos_tok
-        # self.eos_tok = eos_tok
+        self.eos_tok = eso_tok
         # self.itos = itos
         # self.clip = clip
         self.use_cuda = gpu
@@ -696,23 +1175,29 @@ class Seq2SeqAttnmitIntent(nn.Module):
         self.decoder = LuongAttnDecoderRNN(attn_model, hidden_size,self.emb_dim, self.output_size,
                                            self.batch_size, self.n_layers,
                                            intent_size=self.intent_size, dropout=dropout,
-                                           use_cuda=self.use_cuda)
+                                           use_cuda=self.use_cuda, word_counts=word_counts)
 
         if self.use_cuda:
             self.encoder = self.encoder.cuda()
             self.decoder = self.decoder.cuda()
             self.embedding=self.embedding.cuda()
 
-        # Initialize optimizers and criterion
-        self.encoder_optimizer = optim.Adam(self.encoder.parameters(), lr=self.lr)
-        self.decoder_optimizer = optim.Adam(self.decoder.parameters(), lr=self.lr * decoder_learning_ratio)
-        self.optimizer = optim.Adam(self.parameters(), lr=lr)
+        # Initialize the optimizer
+        self.optimizer = build_optimizer(self, self.lr, decoder_learning_ratio)
+        self.accumulated_tokens = 0  # Target tokens of the gradients accumulated since the last optimizer step
+        self.accumulated_samples = 0  # Samples of the per sample loss gradients (sample_grads) accumulated
+        self.sample_grads = {}
         self.plot_every = 20
         self.evaluate_every = 20
         self.loss = 0
+        self.eval_metrics = None  # MetricsAccumulator of the last evaluate_model
 
     def train_batch(self, input_batch, out_batch, input_mask, target_mask, input_length=None,
-                    output_length=None, intent_batch=None,target_kb_mask=None,kb=None):
+                    output_length=None, intent_batch=None,target_kb_mask=None,kb=None, step=True):
+        """
+        Forward and backward pass of a batch
+        :param step: if False, the gradients are accumulated and the optimizer step is deferred (see apply_gradients)
+        """
 
         self.encoder.train(True)
         self.decoder.train(True)
@@ -727,92 +1212,84 @@ class Seq2SeqAttnmitIntent(nn.Module):
             target_mask=target_mask.cuda()
             intent_output=intent_output.cuda()
 
-        inp_emb = self.embedding(input_batch)
-
-        # Zero gradients of both optimizers
-        self.encoder_optimizer.zero_grad()
-        self.decoder_optimizer.zero_grad()
-        self.optimizer.zero_grad()
-
-        # Run words through encoder
-        #input_len = torch.sum(input_mask, dim=0)
-        encoder_outputs, encoder_hidden = self.encoder(inp_emb, input_length)
-        # Prepare input and output variables
-
-        max_target_length = out_batch.shape[0]
-
-        decoder_input = Variable(torch.LongTensor([[self.sos_tok] * self.batch_size])).transpose(0, 1)
-        #     print('decoder_input', decoder_input.size())
-        decoder_context = encoder_outputs[-1]
-        decoder_hidden = encoder_hidden  # Use last hidden state from encoder to start decoder
-
-        all_decoder_outputs = Variable(torch.zeros(max_target_length, self.batch_size, self.output_size))
-
-        if not isinstance(max_target_length, int):
-            max_target_length = int(max_target_length.cpu().numpy()) if self.use_cuda else int(
-                max_target_length.numpy())
-
-        # Prepare input and output variables
-        if self.use_cuda:
-            decoder_input = decoder_input.cuda()
-            all_decoder_outputs = all_decoder_outputs.cuda()
-            # decoder_context = decoder_context.cuda()
-
-        # provide data to decoder
-        # if use_teacher_forcing:
-        if 1:
-            for t in range(max_target_length):
-                inp_emb_d = self.embedding(decoder_input)
-                if t == 0:
-                    decoder_output, decoder_context, decoder_hidden, decoder_attn, intent_score = self.decoder(
-                        inp_emb_d, decoder_context, decoder_hidden, encoder_outputs, input_mask, intent_batch=True
-                    )
-                else:
-                    decoder_output, decoder_context, decoder_hidden, decoder_attn, _ = self.decoder(
-                        inp_emb_d, decoder_context, decoder_hidden, encoder_outputs, input_mask)
-
-                all_decoder_outputs[t] = decoder_output
-                decoder_input = out_batch[t]
-
-        # print (all_decoder_outputs_vocab.size(), out_batch.size())
-        # out_batch = out_batch.transpose(0, 1).contiguous
-        target_mask = target_mask.transpose(0, 1).contiguous()
-        # print (all_decoder_outputs_vocab.size(), out_batch.size(), target_mask.size())
-
-        loss = masked_cross_entropy(
-            all_decoder_outputs.transpose(0, 1).contiguous(),  # -> B x S X VOCAB
-            out_batch.transpose(0, 1).contiguous(),  # -> B x S
-            target_mask
-        )
-
-        loss_function_2 = nn.CrossEntropyLoss()
-
-        intent_loss = loss_function_2(intent_score, intent_output)
-        loss = loss + intent_loss
-
-        if self.use_entity_loss and target_kb_mask is not None:
-            entity_loss = compute_ent_loss(self.embedding,
-                                           all_decoder_outputs.contiguous(),
-                                           out_batch.transpose(0, 1).contiguous(),
-                                           target_kb_mask.transpose(0, 1).contiguous(),
-                                           target_mask)
-
-            loss = loss + entity_loss
+        # Forward pass and losses (under autocast in bf16 precision, the losses are computed in float32)
+        with mixed_precision(self.precision, input_batch.device):
+            inp_emb = self.embedding(input_batch)
+
+            # Zero gradients (unless they are being accumulated)
+            if self.accumulated_tokens == 0:
+                self.optimizer.zero_grad()
+
+            # Run words through encoder
+            #input_len = torch.sum(input_mask, dim=0)
+            encoder_outputs, encoder_hidden = self.encoder(inp_emb, sequence_lengths(input_mask, input_length))
+            # Prepare input and output variables
+
+            max_target_length = out_batch.shape[0]
+            b_size = input_batch.size(1)
+
+            decoder_input = Variable(torch.LongTensor([[self.sos_tok] * b_size])).transpose(0, 1)
+            #     print('decoder_input', decoder_input.size())
+            decoder_context = encoder_outputs[-1]
+            decoder_hidden = encoder_hidden  # Use last hidden state from encoder to start decoder
+
+            # With an adaptive softmax, the decoder outputs are the features and the loss only scores the targets
+            project = not self.decoder.adaptive
+            all_decoder_outputs = Variable(torch.zeros(max_target_length, b_size,
+                                                       self.output_size if project else self.hidden_size))
+
+            if not isinstance(max_target_length, int):
+                max_target_length = int(max_target_length.cpu().numpy()) if self.use_cuda else int(
+                    max_target_length.numpy())
+
+            # Prepare input and output variables
+            if self.use_cuda:
+                decoder_input = decoder_input.cuda()
+                all_decoder_outputs = all_decoder_outputs.cuda()
+                # decoder_context = decoder_context.cuda()
+
+            # provide data to decoder
+            # if use_teacher_forcing:
+            if 1:
+                for t in range(max_target_length):
+                    inp_emb_d = self.embedding(decoder_input)
+                    if t == 0:
+                        decoder_output, decoder_context, decoder_hidden, decoder_attn, intent_score = self.decoder(
+                            inp_emb_d, decoder_context, decoder_hidden, encoder_outputs, input_mask, intent_batch=True,
+                            project=project
+                        )
+                    else:
+                        decoder_output, decoder_context, decoder_hidden, decoder_attn, _ = self.decoder(
+                            inp_emb_d, decoder_context, decoder_hidden, encoder_outputs, input_mask, project=project)
+
+                    all_decoder_outputs[t] = decoder_output
+                    decoder_input = out_batch[t]
+
+            # print (all_decoder_outputs_vocab.size(), out_batch.size())
+            # out_batch = out_batch.transpose(0, 1).contiguous
+            target_mask = target_mask.transpose(0, 1).contiguous()
+            # print (all_decoder_outputs_vocab.size(), out_batch.size(), target_mask.size())
+
+            loss = output_loss(self.decoder.out, all_decoder_outputs, out_batch, target_mask)
+
+            loss_function_2 = nn.CrossEntropyLoss()
+
+            intent_loss = loss_function_2(intent_score.float(), intent_output)  # Per sample, not per target token
+
+            if self.use_entity_loss and target_kb_mask is not None:
+                entity_loss = self.entity_criterion(self.embedding, all_decoder_outputs, out_batch.transpose(0, 1),
+                                                    target_kb_mask.transpose(0, 1), target_mask,
+                                                    predict=lambda outputs: output_predictions(self.decoder.out, outputs))
+
+                loss = loss + entity_loss
 
         #intent_loss.backward(retain_graph=True)
-        loss.backward()
+        accumulate_gradients(self, loss, target_mask, sample_loss=intent_loss, n_samples=intent_output.size(0),
+                             step=step)
+        if step:
+            apply_gradients(self)
 
-        # clip gradient
-        torch.nn.utils.clip_grad_norm_(self.encoder.parameters(), self.clip)
-        torch.nn.utils.clip_grad_norm_(self.decoder.parameters(), self.clip)
-        torch.nn.utils.clip_grad_norm_(self.parameters(), self.clip)
-
-        # Update parameters with optimizers
-        self.encoder_optimizer.step()
-        self.decoder_optimizer.step()
-        self.optimizer.step()
-
-        self.loss += loss.item()
+        self.loss += loss.item() + intent_loss.item()
 
     def evaluate_batch(self, input_batch, out_batch, input_mask, target_mask, input_length=None,
                        output_length=None, intent_batch=None):
@@ -831,18 +1308,19 @@ class Seq2SeqAttnmitIntent(nn.Module):
         inp_emb = self.embedding(input_batch)
 
         # Run through encoder
-        encoder_outputs, encoder_hidden = self.encoder(inp_emb, input_length)
+        encoder_outputs, encoder_hidden = self.encoder(inp_emb, sequence_lengths(input_mask, input_length))
 
         # Create starting vectors for decoder
-        decoder_input = Variable(torch.LongTensor([[self.sos_tok] * self.batch_size])).transpose(0, 1)  # SOS
+        b_size = input_batch.size(1)
+        decoder_input = Variable(torch.LongTensor([[self.sos_tok] * b_size])).transpose(0, 1)  # SOS
 
         decoder_context = encoder_outputs[-1]  # Variable(torch.zeros(batch_size, decoder.hidden_size))
         decoder_hidden = encoder_hidden  # Use last (forward) hidden state from encoder
 
         decoder_maxlength =out_batch.size(0)# max(max(output_length), input_batch.size(0))
 
-        all_decoder_predictions = Variable(torch.zeros(decoder_maxlength, self.batch_size))
-        all_decoder_outputs_vocab = Variable(torch.zeros(int(decoder_maxlength), self.batch_size, self.output_size))
+        all_decoder_predictions = Variable(torch.zeros(decoder_maxlength, b_size))
+        all_decoder_outputs_vocab = Variable(torch.zeros(int(decoder_maxlength), b_size, self.output_size))
         if self.use_cuda:
             decoder_input = decoder_input.cuda()
             # decoder_context = decoder_context.cuda()
@@ -895,45 +1373,150 @@ class Seq2SeqAttnmitIntent(nn.Module):
 
         return all_decoder_predictions, intent_pred, loss_Vocab.item()
 
-    def evaluate_model(self, data, valid=False, test=False):
+    def beam_search(self, input_batch, input_mask, input_length=None, beam_size=5, max_length=None,
+                    length_penalty=1.0):
+        """
+        Beam search decoding (see beam_search_decode)
+        :param input_batch: S X B
+        :param input_mask: S X B
+        :param max_length: defaults to the input length
+        :return: decoded T X B, intent predictions B X 1, scores B
+        """
+        self.encoder.train(False)
+        self.decoder.train(False)
+        self.embedding.train(False)
+
+        if self.use_cuda:
+            input_batch = input_batch.cuda()
+            input_mask = input_mask.cuda()
+
+        with torch.no_grad():
+            inp_emb = self.embedding(input_batch)
+            encoder_outputs, encoder_hidden = self.encoder(inp_emb, sequence_lengths(input_mask, input_length))
+            b_size = input_batch.size(1)
+
+            index = torch.arange(b_size, device=inp_emb.device).repeat_interleave(beam_size)
+            encoder_outputs = encoder_outputs[:, index]
+            input_mask = input_mask[:, index]
+            decoder_state = (encoder_outputs[-1], (encoder_hidden[0][:, index], encoder_hidden[1][:, index]))
+            intent_pred = []
+
+            def step(words, state, t):
+                decoder_context, decoder_hidden = state
+                inp_emb_d = self.embedding(words.unsqueeze(1))
+                decoder_output, decoder_context, decoder_hidden, _, intent_scores = self.decoder(
+                    inp_emb_d, decoder_context, decoder_hidden, encoder_outputs, input_mask, intent_batch=(t == 0))
+                if t == 0:  # Same for all the beams of a sample
+                    intent_pred.append(intent_scores.view(b_size, beam_size, -1)[:, 0].topk(1)[1])
+                return decoder_output, (decoder_context, decoder_hidden)
+
+            def reorder(state, index):
+                decoder_context, decoder_hidden = state
+                return decoder_context[index], (decoder_hidden[0][:, index], decoder_hidden[1][:, index])
+
+            decoded, scores = beam_search_decode(step, decoder_state, reorder, b_size, beam_size, self.sos_tok,
+                                                 self.eos_tok, max_length or input_batch.size(0), length_penalty,
+                                                 device=inp_emb.device)
+
+        self.encoder.train(True)
+        self.decoder.train(True)
+        self.embedding.train(True)
+        return decoded, intent_pred[0], scores
+
+    def predict(self, input_batch, input_mask, input_length=None, max_length=None):
+        """
+        Greedy decoding for inference, stopping as soon as every sequence has produced <eos> (see
+        Seq2SeqmitAttn.predict)
+        :param max_length: defaults to the input length
+        :return: decoded T X B (padded with 0 after <eos>), intent predictions B X 1
+        """
+        self.encoder.train(False)
+        self.decoder.train(False)
+        self.embedding.train(False)
+
+        if self.use_cuda:
+            input_batch = input_batch.cuda()
+            input_mask = input_mask.cuda()
+
+        with torch.no_grad():
+            inp_emb = self.embedding(input_batch)
+            encoder_outputs, encoder_hidden = self.encoder(inp_emb, sequence_lengths(input_mask, input_length))
+            b_size = input_batch.size(1)
+
+            decoder_input = torch.full((b_size, 1), self.sos_tok, dtype=torch.long, device=inp_emb.device)
+            decoder_context = encoder_outputs[-1]
+            decoder_hidden = encoder_hidden
+            finished = torch.zeros(b_size, dtype=torch.bool, device=inp_emb.device)
+            decoded_words = []
+            for di in range(max_length or input_batch.size(0)):
+                decoder_output, decoder_context, decoder_hidden, _, intent_scores = self.decoder(
+                    self.embedding(decoder_input), decoder_context, decoder_hidden, encoder_outputs, input_mask,
+                    intent_batch=(di == 0))
+                if di == 0:
+                    intent_pred = intent_scores.topk(1)[1]
+                decoder_input = decoder_output.topk(1)[1]
+
+                words = decoder_input.view(-1)
+                decoded_words.append(words.masked_fill(finished, 0))
+                finished = finished | (words == self.eos_tok)
+                if finished.all():
+                    break
+
+        self.encoder.train(True)
+        self.decoder.train(True)
+        self.embedding.train(True)
+        return torch.stack(decoded_words), intent_pred
+
+    def evaluate_model(self, data, valid=False, test=False, beam_size=1, compute_loss=True):
+        """
+        Decode the valid/test set and compute the BLEU scores
+        :param beam_size: 1 for greedy decoding
+        :param compute_loss: if False, the sequences are only predicted (early exit, no logits kept) and the
+            returned loss is None
+        """
 
         if test:
             batches = data.getTestingBatch(self.batch_size)
             output_file = open(os.path.join(os.path.join("trained_model", self.__class__.__name__), "output_file.txt"),
                                "w")
         elif valid:
-            batches = data.getBatches(self.batch_size, valid=True, transpose=False)
+            batches = data.iterBatches(self.batch_size, valid=True, pin=self.use_cuda)
         else:
-            batches = data.getBatches(self.batch_size, test=True, transpose=False)
+            batches = data.iterBatches(self.batch_size, test=True, pin=self.use_cuda)
             output_file = open(os.path.join(os.path.join("trained_model", self.__class__.__name__), "output_file.txt"),
                                "w")
 
-        all_predicted = []
-        target_batches = []
-        individual_metric = []
-        eval_loss=0
+        # BLEU, WER and loss, accumulated batch by batch (the hypothesis/reference files are written for the test set)
+        metrics = MetricsAccumulator(data.cleanSequence, sequence2str=data.sequence2str,
+                                     directory=os.path.join("trained_model", self.__class__.__name__)
+                                     if not valid and not test else None,
+                                     embedding_metrics=corpus_embedding_metrics(data),
+                                     entity_metrics=corpus_entity_metrics(data))
 
         for batch in batches:
-            input_batch = Variable(torch.LongTensor(batch.encoderSeqs)).transpose(0, 1)
-            target_batch = Variable(torch.LongTensor(batch.targetSeqs)).transpose(0, 1)
-            print(batch.encoderMaskSeqs)
-            input_batch_mask = Variable(torch.FloatTensor(batch.encoderMaskSeqs)).transpose(0, 1)
-            target_batch_mask = Variable(torch.FloatTensor(batch.decoderMaskSeqs)).transpose(0, 1)
-
-
-            decoded_words, intent, loss = self.evaluate_batch(input_batch, target_batch, input_batch_mask, target_batch_mask,
-                                                batch.encoderSeqsLen, batch.decoderSeqsLen)
+            loss = None
+            input_batch = batch.encoderTensor
+            target_batch = batch.targetTensor
+            input_batch_mask = batch.encoderMaskTensor
+            target_batch_mask = batch.decoderMaskTensor
+
+
+            if compute_loss:
+                decoded_words, intent, loss = self.evaluate_batch(input_batch, target_batch, input_batch_mask,
+                                                                  target_batch_mask, batch.encoderSeqsLen,
+                                                                  batch.decoderSeqsLen)
+            elif beam_size == 1:
+                decoded_words, intent = self.predict(input_batch, input_batch_mask, batch.encoderSeqsLen,
+                                                     max_length=target_batch.size(0))
+            if beam_size > 1:  # The loss is still the greedy one
+                decoded_words, intent, _ = self.beam_search(input_batch, input_batch_mask, batch.encoderSeqsLen,
+                                                            beam_size, max_length=target_batch.size(0))
 
-            eval_loss += loss
             batch_predictions = decoded_words.transpose(0, 1)
+            metrics.update(batch_predictions, batch.targetSeqs, loss, kb=batch.kbArray, intents=batch.seqIntent)
 
-            batch_metric_score = 0
-            for i, sen in enumerate(batch_predictions):
-                predicted = data.sequence2str(sen.cpu().numpy(), clean=True)
-                reference = data.sequence2str(batch.targetSeqs[i], clean=True)
-                batch_metric_score += nltk.translate.bleu_score.sentence_bleu([reference], predicted)
-
-                if not valid:
+            if not valid:
+                for i in range(len(batch_predictions)):
                     output_file.write("\n"+"Input : " +
                                                 data.sequence2str(batch.encoderSeqs[i], clean=True))
 
@@ -948,23 +1531,9 @@ class Seq2SeqAttnmitIntent(nn.Module):
                     output_file.write("\n")
                     output_file.flush()
 
-            batch_metric_score = batch_metric_score / self.batch_size
-
-            all_predicted.append(batch_predictions)
-            target_batches.append(batch.targetSeqs)
-            individual_metric.append(batch_metric_score)
-
-        candidates, references = data.get_candidates(target_batches, all_predicted)
-
-        global_metric_score = nltk.translate.bleu_score.corpus_bleu(references, candidates)
-
-        candidates2, references2 = data.get_candidates(target_batches, all_predicted, True)
-        if not valid and not test:
-            moses_multi_bleu_score = moses_multi_bleu(candidates2,references2, True, os.path.join("trained_model", self.__class__.__name__))
-        else:
-            moses_multi_bleu_score = moses_multi_bleu(candidates2, references2, True)
-
-        return global_metric_score, individual_metric, moses_multi_bleu_score, eval_loss/len(batches)
+        global_metric_score, individual_metric, moses_multi_bleu_score, eval_loss = metrics.finalize()
+        self.eval_metrics = metrics  # The other metrics of the last evaluation (WER, embedding and entity metrics)
+        return global_metric_score, individual_metric, moses_multi_bleu_score, eval_loss
 
 
 
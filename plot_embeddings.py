@@ -20,9 +20,12 @@ plotting_sentences = ["i have a doctor appointment next month on the 13 th at 11
 # plt.annotate(word, xy=(representation[0], representation[1]), xytext=(5, 2),
 #              textcoords='offset points', ha='right', va='bottom')
 
+word_to_embedding_dict = textdata.load_embedding_from_disks(
+    glove_filename, words=[word for sentence in plotting_sentences for word in sentence.split(" ")])
+
 for sentence in plotting_sentences:
     for word in sentence.split(" "):
-        x.append(textdata.word_to_embedding_dict[word])
+        x.append(word_to_embedding_dict[word])
         s.append(word)
 
 hyp.plot(np.array(x), '.', ndims=2, labels=s,
@@ -4,11 +4,12 @@ import math
 import socket
 import os
 import argparse
+import resource
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 from corpus.textdata import TextData
-from model.seq2seq_model import Seq2SeqmitAttn, Seq2SeqAttnmitIntent  # KVEncoderRNN, KVAttnDecoderRNN,
+from model.seq2seq_model import Seq2SeqmitAttn, Seq2SeqAttnmitIntent, apply_gradients  # KVEncoderRNN, KVAttnDecoderRNN,
 
 import torch
 
@@ -41,8 +42,10 @@ def main(args):
     valid_file = 'data/kvret_dev_public.json'
     test_file = 'data/kvret_test_public.json'
     textdata = TextData(train_file, valid_file, test_file, pretrained_emb_file=args.emb,
-                        useGlove=args.glove)
+                        useGlove=args.glove, nlpWorkers=args.nlp_workers)
 
+    textdata.bucketBatches = args.bucket
+    textdata.maxBatchTokens = args.max_tokens
     args.data = textdata
 
     print('Datasets Loaded.')
@@ -61,17 +64,22 @@ def main(args):
     avg_best_metric = 0
     save_every = 20
 
+    # Adaptive softmax output, its clusters are based on the frequency of the words in the training targets
+    word_counts = textdata.getTargetWordCounts() if args.adaptive_softmax else None
+
     # Initialize models
     if args.intent:
         model = Seq2SeqAttnmitIntent(attn_model, hidden_size,textdata.getVocabularySize(), textdata.getVocabularySize(),
                                  args.batch_size, textdata.word2id['<go>'], textdata.word2id['<eos>'], gpu=args.cuda,
-                                     clip=args.clip, lr=args.lr, pretrained_emb=textdata.pretrained_emb, dropout=0.1)
+                                     clip=args.clip, lr=args.lr, pretrained_emb=textdata.pretrained_emb, dropout=0.1,
+                                     word_counts=word_counts, precision=args.precision)
     else:
         model = Seq2SeqmitAttn(hidden_size, textdata.getTargetMaxLength(), textdata.getVocabularySize(),
                                args.batch_size, hidden_size, textdata.word2id['<go>'], textdata.word2id['<eos>'],
                                None, gpu=args.cuda, lr=args.lr, train_emb=True,
                                n_layers=1, clip=args.clip, pretrained_emb=textdata.pretrained_emb, dropout=0.1, emb_drop=0.1,
-                               teacher_forcing_ratio=0.0,use_entity_loss=True,entities_property=textdata.entities_property)
+                               teacher_forcing_ratio=0.0,use_entity_loss=True,entities_property=textdata.entities_property,
+                               word_counts=word_counts, precision=args.precision)
 
     if args.emb:
         directory = os.path.join("trained_model", model.__class__.__name__, (args.emb).split(".")[0])
@@ -104,10 +112,14 @@ def main(args):
 
     if args.val:
         global_metric_score, individual_metric, moses_multi_bleu_score, loss = \
-            model.evaluate_model(textdata)
+            model.evaluate_model(textdata, beam_size=args.beam_size, compute_loss=False)
         print("Model Bleu using corpus bleu: ", global_metric_score)
         print("Model Bleu using sentence bleu: ", sum(individual_metric)/len(individual_metric))
         print("Model Bleu using moses_multi_bleu_score :", moses_multi_bleu_score)
+        print("Model WER (corpus, sentence average) :", model.eval_metrics.wer())
+        print("Model embedding average, vector extrema, greedy matching :", model.eval_metrics.embedding_scores())
+        print("Model entity F1 and KB retrieval accuracy per domain :")
+        print(model.eval_metrics.entity_table())
     else:
         total_loss = 0
         while epoch < n_epochs:
@@ -116,40 +128,50 @@ def main(args):
 
             if args.test:
                 batches = textdata.getTestingBatch(args.batch_size)
+                total_batches = len(batches)
             else:
-                batches = textdata.getBatches(args.batch_size, transpose=False)
+                batches = textdata.iterBatches(args.batch_size, prefetch=args.prefetch, pin=args.cuda)
+                total_batches = textdata.getBatchCount(args.batch_size)
 
             # steps_per_epoch = len(batches)
+            epoch_start = time.time()
             try:
 
                 epoch_ec = 0
                 epoch_dc = 0
 
-                for current_batch in tqdm(batches, desc='Processing batches'):
+                n_batches = 0
+                for current_batch in tqdm(batches, desc='Processing batches', total=total_batches):
+                    n_batches += 1
 
                     kb_batch=current_batch.kb_inputs
                     intent_batch = current_batch.seqIntent
 
-                    # Turn padded arrays into (batch_size x max_len) tensors, transpose into (max_len x batch_size)
+                    # (max_len x batch_size) tensors, built with the batch
                     target_lengths = current_batch.decoderSeqsLen
                     input_lengths = current_batch.encoderSeqsLen
 
-                    input_batch = Variable(torch.LongTensor(current_batch.encoderSeqs)).transpose(0, 1)
-                    target_batch = Variable(torch.LongTensor(current_batch.targetSeqs)).transpose(0, 1)
-                    input_batch_mask = Variable(torch.FloatTensor(current_batch.encoderMaskSeqs)).transpose(0, 1)
-                    target_batch_mask = Variable(torch.FloatTensor(current_batch.decoderMaskSeqs)).transpose(0, 1)
-                    target_kb_mask = Variable(torch.LongTensor(current_batch.targetKbMask)).transpose(0, 1)
+                    input_batch = current_batch.encoderTensor
+                    target_batch = current_batch.targetTensor
+                    input_batch_mask = current_batch.encoderMaskTensor
+                    target_batch_mask = current_batch.decoderMaskTensor
+                    target_kb_mask = current_batch.targetKbMaskTensor
+
+                    # Optimizer step every args.accumulate batches (the gradients are averaged over their tokens)
+                    step = n_batches % args.accumulate == 0
 
                     # Train Model
                     if args.intent:
                         model.train_batch(input_batch, target_batch, input_batch_mask, target_batch_mask,
-                                          input_lengths,target_lengths, intent_batch)
+                                          input_lengths,target_lengths, intent_batch, step=step)
                     elif args.kb:
                         model.train_batch(input_batch, target_batch, input_batch_mask, target_batch_mask,
-                                          input_lengths, target_lengths, intent_batch, kb_batch)
+                                          input_lengths, target_lengths, intent_batch, kb_batch, step=step)
                     else:
                         model.train_batch(input_batch, target_batch, input_batch_mask, target_batch_mask,
-                                          target_kb_mask=target_kb_mask)
+                                          input_length=input_lengths, target_kb_mask=target_kb_mask, step=step)
+
+                apply_gradients(model)  # Last accumulated batches of the epoch
 
                 # Keep track of loss
                 print_loss_total += model.loss
@@ -160,6 +182,10 @@ def main(args):
                 epoch_loss = model.loss-total_loss
                 total_loss = model.loss
                 print(epoch, epoch_loss, "epoch-loss")
+                epoch_time = time.time() - epoch_start
+                print('{} training: {:.1f}s, {:.1f} batches/s, peak memory {:.0f} MB'.format(
+                    args.precision, epoch_time, n_batches / epoch_time,
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
 
                 # if epoch == 1:
                 #     evaluate_randomly(args, textdata, encoder, decoder)
@@ -173,16 +199,21 @@ def main(args):
                     print(print_summary)
 
                     global_metric_score, individual_metric, moses_multi_bleu_score, eval_loss = \
-                        model.evaluate_model(textdata, valid=True, test=args.test)
+                        model.evaluate_model(textdata, valid=True, test=args.test, beam_size=args.beam_size)
 
                     print("Model Bleu using corpus bleu: ", global_metric_score)
                     print("Model Bleu using sentence bleu: ", sum(individual_metric) / len(individual_metric))
                     print("Model Bleu using moses_multi_bleu_score :", moses_multi_bleu_score)
+                    print("Model WER (corpus, sentence average) :", model.eval_metrics.wer())
+                    print("Model embedding average, vector extrema, greedy matching :",
+                          model.eval_metrics.embedding_scores())
+                    print("Model entity F1 and KB retrieval accuracy per domain :")
+                    print(model.eval_metrics.entity_table())
                     print("Model Loss :", eval_loss)
                     bleu =moses_multi_bleu_score
                     max(global_metric_score, sum(individual_metric) / len(individual_metric),
                                moses_multi_bleu_score/100)
-                    plot_losses.append(epoch_loss/len(batches))
+                    plot_losses.append(epoch_loss/n_batches)
                     val_plot_loss_total.append(eval_loss)
                     epoc_plot.append(epoch)
                     if bleu > avg_best_metric:
@@ -245,10 +276,14 @@ def main(args):
         print('Model training complete.')
 
         global_metric_score, individual_metric, moses_multi_bleu_score, eval_loss = \
-            model.evaluate_model(textdata, test=args.test)
+            model.evaluate_model(textdata, test=args.test, beam_size=args.beam_size)
         print("Test Model Bleu using corpus bleu: ", global_metric_score)
         print("Test Model Bleu using sentence bleu: ", sum(individual_metric) / len(individual_metric))
         print("Test Model Bleu using moses_multi_bleu_score :", moses_multi_bleu_score)
+        print("Test Model WER (corpus, sentence average) :", model.eval_metrics.wer())
+        print("Test Model embedding average, vector extrema, greedy matching :", model.eval_metrics.embedding_scores())
+        print("Test Model entity F1 and KB retrieval accuracy per domain :")
+        print(model.eval_metrics.entity_table())
         print("Model Loss on test:", eval_loss)
         print('Saving Model.')
         torch.save(model.state_dict(), os.path.join(directory, '{}_{}.bin'.format(epoch, str(moses_multi_bleu_score/100))))
@@ -345,6 +380,42 @@ if __name__ == '__main__':
                             help="""model learning rate """,
                             required=False, default=2.0, type=float)
 
+    named_args.add_argument('-nlpw', '--nlp-workers', metavar='|',
+                            help="""spaCy processes used to build the corpus (0 parses one utterance at a time) """,
+                            required=False, default=0, type=int)
+
+    named_args.add_argument('-pf', '--prefetch', metavar='|',
+                            help="""batches prepared in advance by a background thread (0 to disable) """,
+                            required=False, default=4, type=int)
+
+    named_args.add_argument('-bucket', '--bucket', metavar='|',
+                            help="""group the samples by length and pad each batch to its longest sample """,
+                            required=False, default=False, type=bool)
+
+    named_args.add_argument('-mt', '--max-tokens', metavar='|',
+                            help="""token budget of a batch (batch size x padded input + target length), implies
+                            --bucket, the batch size is then the max number of samples """,
+                            required=False, default=None, type=int)
+
+    named_args.add_argument('-beam', '--beam-size', metavar='|',
+                            help="""beam size used to decode at evaluation (1 is greedy decoding) """,
+                            required=False, default=1, type=int)
+
+    named_args.add_argument('-as', '--adaptive-softmax', metavar='|',
+                            help="""train with an adaptive softmax output layer instead of the full vocabulary
+                            softmax (the evaluation still uses the full distribution) """,
+                            required=False, default=False, type=bool)
+
+    named_args.add_argument('-acc', '--accumulate', metavar='|',
+                            help="""number of batches whose gradients are accumulated before each optimizer step
+                            (averaged over their target tokens) """,
+                            required=False, default=1, type=int)
+
+    named_args.add_argument('-precision', '--precision', metavar='|',
+                            help="""training precision: fp32, or bf16 to run the embedding, LSTMs and projections
+                            under bfloat16 autocast (the losses stay in float32) """,
+                            required=False, default='fp32', choices=['fp32', 'bf16'])
+
     args = parser.parse_args()
     if args.cuda:
         USE_CUDA = True
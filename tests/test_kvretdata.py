@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+from corpus.kvretdata import iterJsonArray
+
+
+DOCUMENTS = [
+    '[1.25, 2e5, 3]',
+    '[-0.5,1E-3 , 10,\n 7.0e+2]',
+    '[true, false, null, "a, b]", 12]',
+    '[{"a": [1.5, 2]}, [3e1, {"b": "c"}], 4.75]',
+    ' [ ] ',
+]
+
+
+@pytest.mark.parametrize('text', DOCUMENTS)
+@pytest.mark.parametrize('chunkSize', [1, 2, 3, 5, 7, 1 << 16])
+def test_iterJsonArray_matches_json_load(tmp_path, text, chunkSize):
+    fileName = tmp_path / 'array.json'
+    fileName.write_text(text)
+    assert list(iterJsonArray(str(fileName), chunkSize)) == json.loads(text)
+
+
+@pytest.mark.parametrize('text', ['[1, 2', '[1.25,', '', '[{"a": 1}'])
+@pytest.mark.parametrize('chunkSize', [1, 3, 1 << 16])
+def test_iterJsonArray_truncated(tmp_path, text, chunkSize):
+    fileName = tmp_path / 'array.json'
+    fileName.write_text(text)
+    with pytest.raises(ValueError):
+        json.loads(text)
+    with pytest.raises(ValueError):
+        list(iterJsonArray(str(fileName), chunkSize))
@@ -12,30 +12,309 @@ import numpy as np
 
 from six.moves import urllib
 
+def pad_sequences(sequences, pad=-1):
+    """
+    Stack sequences of token ids into a (number of sequences, max length) array, padded with pad
+    Returns:
+    The array and the length of each sequence.
+    """
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    padded = np.full((len(sequences), max(int(lengths.max()), 1) if len(sequences) else 1), pad, dtype=np.int64)
+    padded[np.arange(padded.shape[1]) < lengths[:, None]] = np.concatenate(
+        [np.asarray(sequence, dtype=np.int64).ravel() for sequence in sequences]) if len(sequences) else []
+    return padded, lengths
+
+
+def edit_distances(references, hypotheses):
+    """
+    Levenshtein distance (substitutions, insertions and deletions) between each reference and its hypothesis
+    The dynamic programming matrices of the whole batch are filled one anti-diagonal at a time: the cells (i, j) with
+    i + j = k only depend on the diagonals k - 1 and k - 2, so each diagonal is one vectorized step.
+    Args:
+    references: list of token id sequences
+    hypotheses: list of token id sequences, one per reference
+    Returns:
+    np.array of the distances
+    """
+    if len(references) == 0:
+        return np.zeros(0, dtype=np.int64)
+    reference, reference_lengths = pad_sequences(references, pad=-1)
+    hypothesis, hypothesis_lengths = pad_sequences(hypotheses, pad=-2)  # Padding never matches
+    n, rows, columns = len(references), reference.shape[1], hypothesis.shape[1]
+
+    distances = np.zeros((n, rows + 1, columns + 1), dtype=np.int64)
+    distances[:, :, 0] = np.arange(rows + 1)
+    distances[:, 0, :] = np.arange(columns + 1)
+    for k in range(2, rows + columns + 1):
+        i = np.arange(max(1, k - columns), min(rows, k - 1) + 1)
+        j = k - i
+        substitute = distances[:, i - 1, j - 1] + (reference[:, i - 1] != hypothesis[:, j - 1])
+        insert = distances[:, i, j - 1] + 1
+        delete = distances[:, i - 1, j] + 1
+        distances[:, i, j] = np.minimum(substitute, np.minimum(insert, delete))
+
+    # The padding is at the end, so the distance of each pair is the cell of its real lengths
+    return distances[np.arange(n), reference_lengths, hypothesis_lengths]
+
+
+def batch_wer(references, hypotheses):
+    """
+    Word error rates of a batch
+    Args:
+    references: list of token id sequences
+    hypotheses: list of token id sequences, one per reference
+    Returns:
+    The WER of each sentence and the corpus WER (total edits over total reference length), in percent, and the edit
+    distances (to accumulate the corpus WER over several batches)
+    """
+    distances = edit_distances(references, hypotheses)
+    reference_lengths = np.array([len(reference) for reference in references], dtype=np.int64)
+    sentence_wer = distances / np.maximum(reference_lengths, 1) * 100
+    corpus_wer = distances.sum() / max(reference_lengths.sum(), 1) * 100
+    return sentence_wer, float(corpus_wer), distances
+
+
 def wer(r, h):
     """
     This is a function that calculate the word error rate in ASR.
     You can use it like this: wer("what is it".split(), "what is".split()) 
     """
-    #build the matrix
-    d = numpy.zeros((len(r)+1)*(len(h)+1), dtype=numpy.uint8).reshape((len(r)+1, len(h)+1))
-    for i in range(len(r)+1):
-        for j in range(len(h)+1):
-            if i == 0: d[0][j] = j
-            elif j == 0: d[i][0] = i
-    for i in range(1,len(r)+1):
-        for j in range(1, len(h)+1):
-            if r[i-1] == h[j-1]:
-                d[i][j] = d[i-1][j-1]
-            else:
-                substitute = d[i-1][j-1] + 1
-                insert = d[i][j-1] + 1
-                delete = d[i-1][j] + 1
-                d[i][j] = min(substitute, insert, delete)
-    result = float(d[len(r)][len(h)]) / len(r) * 100
+    vocabulary = {}
+    r = [vocabulary.setdefault(word, len(vocabulary)) for word in r]
+    h = [vocabulary.setdefault(word, len(vocabulary)) for word in h]
+    result = float(edit_distances([r], [h])[0]) / len(r) * 100
     # result = str("%.2f" % result) + "%"
     return result
 
+
+def ngram_keys(sequences, n):
+    """
+    Hash the n-grams of integer sequences, vectorized over the whole corpus
+    Args:
+    sequences: list of sequences of non negative integers (token ids)
+    n: the n-gram order
+    Returns:
+    The index of the sequence of each n-gram and its key (the ids packed in base max id + 1, modulo 2^64, which is
+    exact as long as (max id + 1) ** n < 2^64 and a hash otherwise).
+    """
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    flat = np.concatenate([np.asarray(sequence, dtype=np.uint64).ravel() for sequence in sequences]) \
+        if len(sequences) else np.zeros(0, dtype=np.uint64)
+    ends = np.repeat(np.cumsum(lengths), lengths)  # End of the sequence of each token
+    positions = np.nonzero(np.arange(len(flat)) + n <= ends)[0]  # The n-grams which fit in their sequence
+    sentence = np.repeat(np.arange(len(sequences)), lengths)[positions]
+    base = np.uint64(int(flat.max()) + 1 if len(flat) else 1)
+    keys = np.zeros(len(positions), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for k in range(n):
+            keys = keys * base + flat[positions + k]
+    return sentence, keys
+
+
+def ngram_matches(hypotheses, references, n):
+    """
+    Clipped n-gram matches of each hypothesis against its reference
+    Returns:
+    For each hypothesis, its number of matches (each n-gram counted at most as many times as it occurs in the
+    reference) and its number of n-grams.
+    """
+    # The same id packing for the hypotheses and the references, so their keys can be compared
+    sentence, keys = ngram_keys(list(hypotheses) + list(references), n)
+    is_reference = sentence >= len(hypotheses)
+    sentence = np.where(is_reference, sentence - len(hypotheses), sentence)
+
+    # Group the equal (sentence, n-gram) pairs, and count each side in every group
+    order = np.lexsort((keys, sentence))
+    sentence, keys, is_reference = sentence[order], keys[order], is_reference[order]
+    new_group = np.ones(len(keys), dtype=bool)
+    new_group[1:] = (sentence[1:] != sentence[:-1]) | (keys[1:] != keys[:-1])
+    group = np.cumsum(new_group) - 1
+    reference_counts = np.bincount(group, weights=is_reference)
+    hypothesis_counts = np.bincount(group, weights=~is_reference)
+    matches = np.bincount(sentence[new_group], weights=np.minimum(hypothesis_counts, reference_counts),
+                          minlength=len(hypotheses))
+    totals = np.bincount(sentence[~is_reference], minlength=len(hypotheses))
+    return matches.astype(np.int64), totals.astype(np.int64)
+
+
+def bleu_statistics(hypotheses, references, max_order=4):
+    """
+    Sufficient statistics of the BLEU of each hypothesis, as accumulated by multi-bleu.perl
+    Args:
+    hypotheses: list of token id sequences
+    references: list of token id sequences, one reference per hypothesis
+    Returns:
+    np.array (number of hypotheses, 2 * max_order + 2) of integers: the clipped n-gram matches and the n-gram totals
+    of each order, then the hypothesis and the reference lengths. Sum the rows to get the corpus statistics.
+    """
+    stats = np.zeros((len(hypotheses), 2 * max_order + 2), dtype=np.int64)
+    for n in range(1, max_order + 1):
+        stats[:, n - 1], stats[:, max_order + n - 1] = ngram_matches(hypotheses, references, n)
+    stats[:, 2 * max_order] = [len(hypothesis) for hypothesis in hypotheses]
+    stats[:, 2 * max_order + 1] = [len(reference) for reference in references]
+    return stats
+
+
+def bleu_score(stats, max_order=4):
+    """
+    BLEU of statistics (see bleu_statistics), vectorized over the leading dimensions
+    Returns:
+    The BLEU, between 0 and 1 (0 when an n-gram order has no match, as multi-bleu.perl does).
+    """
+    stats = np.asarray(stats, dtype=np.float64)
+    correct, total = stats[..., :max_order], stats[..., max_order:2 * max_order]
+    hypothesis_length, reference_length = stats[..., 2 * max_order], stats[..., 2 * max_order + 1]
+    valid = (hypothesis_length > 0) & np.all(correct > 0, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_precision = np.mean(np.log(np.where(correct > 0, correct / np.maximum(total, 1), 1)), axis=-1)
+        brevity_penalty = np.where(hypothesis_length < reference_length,
+                                   np.exp(1 - reference_length / np.maximum(hypothesis_length, 1)), 1.0)
+    return np.where(valid, brevity_penalty * np.exp(log_precision), 0.0)
+
+
+def bleu_from_statistics(stats, max_order=4):
+    """
+    BLEU score of corpus statistics, rounded like multi-bleu.perl
+    Returns:
+    The BLEU score, between 0 and 100, with 2 decimals.
+    """
+    return float('%.2f' % (100 * bleu_score(stats, max_order)))
+
+
+def multi_bleu(hypotheses, references, max_order=4):
+    """Corpus BLEU of token id sequences, in process: same score as multi-bleu.perl on the space joined tokens
+    Args:
+    hypotheses: list of token id sequences (lists, numpy arrays)
+    references: list of token id sequences, one reference per hypothesis
+    Returns:
+    The BLEU score, between 0 and 100, with 2 decimals.
+    """
+    if len(hypotheses) == 0:
+        return 0.0
+    return bleu_from_statistics(bleu_statistics(hypotheses, references, max_order).sum(0), max_order)
+
+
+class MetricsAccumulator:
+    """Corpus BLEU, average sentence BLEU, WER, embedding and entity metrics and loss of an evaluation, updated batch
+    by batch
+    Only the n-gram statistics, the edit counts and the metric sums are kept, not the decoded sentences.
+    """
+
+    def __init__(self, clean, max_order=4, sequence2str=None, directory=None, embedding_metrics=None,
+                 entity_metrics=None):
+        """
+        Args:
+        clean: function returning the token ids of a sequence which are scored (e.g. TextData.cleanSequence)
+        sequence2str: function converting the ids to a sentence, needed to write the files
+        directory: if given, the hypotheses and the references are written there
+        embedding_metrics: if given, an util.metrics.EmbeddingMetrics over the word ids
+        entity_metrics: if given, an util.metrics.EntityMetrics (needs the KB and the intents in update)
+        """
+        self.clean = clean
+        self.max_order = max_order
+        self.sequence2str = sequence2str
+        self.stats = np.zeros(2 * max_order + 2, dtype=np.int64)
+        self.sentence_bleu_sum = 0.0
+        self.n_sentences = 0
+        self.batch_sentence_bleu = []  # Average sentence BLEU of each batch
+        self.loss_sum = 0.0
+        self.n_losses = 0
+        self.edit_sum = 0
+        self.reference_length = 0
+        self.sentence_wer_sum = 0.0
+        self.embedding_metrics = embedding_metrics
+        self.embedding_sums = np.zeros(3)  # Embedding average, vector extrema, greedy matching
+        self.entity_metrics = entity_metrics
+        self.files = None
+        if directory is not None:
+            self.files = [open(os.path.join(directory, name), "w")
+                          for name in ("hypothesis_file.txt", "reference_file.txt")]
+
+    def update(self, predictions, references, loss=None, kb=None, intents=None):
+        """
+        Args:
+        predictions: B X T predicted ids (tensor or array)
+        references: B X T target ids
+        loss: the loss of the batch, if computed
+        kb: B X M X 3 KB triples of the samples, padded with -1 (Batch.kbArray)
+        intents: B intent ids (Batch.seqIntent)
+        """
+        if hasattr(predictions, 'cpu'):
+            predictions = predictions.cpu().numpy()
+        hypotheses = [self.clean(sequence) for sequence in predictions]
+        references = [self.clean(sequence) for sequence in references]
+        stats = bleu_statistics(hypotheses, references, self.max_order)
+        self.stats += stats.sum(0)
+
+        sentence_bleu = bleu_score(stats, self.max_order)
+        self.sentence_bleu_sum += sentence_bleu.sum()
+        self.n_sentences += len(sentence_bleu)
+        self.batch_sentence_bleu.append(float(sentence_bleu.mean()) if len(sentence_bleu) else 0.0)
+
+        sentence_wer, _, distances = batch_wer(references, hypotheses)
+        self.edit_sum += int(distances.sum())
+        self.reference_length += sum(len(reference) for reference in references)
+        self.sentence_wer_sum += float(sentence_wer.sum())
+
+        if self.embedding_metrics is not None:
+            scores = self.embedding_metrics.get_scores_batch(references, hypotheses, ids=True)
+            self.embedding_sums += [score.sum() for score in scores]
+
+        if self.entity_metrics is not None and kb is not None:
+            self.entity_metrics.update(hypotheses, references, kb, intents)
+
+        if loss is not None:
+            self.loss_sum += loss
+            self.n_losses += 1
+
+        if self.files is not None:
+            for f, sequences in zip(self.files, (hypotheses, references)):
+                for sequence in sequences:
+                    f.write(self.sequence2str(sequence, clean=True) + "\n")
+
+    def finalize(self):
+        """
+        Returns:
+        The corpus BLEU (between 0 and 1), the average sentence BLEU of each batch, the multi-bleu.perl score
+        (between 0 and 100, 2 decimals) and the average batch loss (None if no loss was given).
+        """
+        if self.files is not None:
+            for f in self.files:
+                f.close()
+            self.files = None
+        corpus_bleu = float(bleu_score(self.stats, self.max_order))
+        multi_bleu_score = bleu_from_statistics(self.stats, self.max_order) if self.n_sentences else 0.0
+        loss = self.loss_sum / self.n_losses if self.n_losses else None
+        return corpus_bleu, self.batch_sentence_bleu, multi_bleu_score, loss
+
+    def wer(self):
+        """
+        Returns:
+        The corpus WER (total edits over total reference length) and the average sentence WER, in percent
+        """
+        corpus_wer = self.edit_sum / max(self.reference_length, 1) * 100
+        sentence_wer = self.sentence_wer_sum / self.n_sentences if self.n_sentences else 0.0
+        return corpus_wer, sentence_wer
+
+    def embedding_scores(self):
+        """
+        Returns:
+        The average embedding average, vector extrema and greedy matching scores, or None without embedding_metrics
+        """
+        if self.embedding_metrics is None:
+            return None
+        return tuple(float(score) for score in self.embedding_sums / max(self.n_sentences, 1))
+
+    def entity_table(self):
+        """
+        Returns:
+        The entity F1 and KB retrieval accuracy table, one line per domain, or None without entity_metrics
+        """
+        if self.entity_metrics is None:
+            return None
+        return self.entity_metrics.table()
+
+
 # -*- coding: utf-8 -*-
 # Copyright 2017 Google Inc.
 #
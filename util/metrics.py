@@ -1,11 +1,25 @@
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+
+from util.measures import pad_sequences
 
 
 class EmbeddingMetrics():
-    def __init__(self, embeddig_dict, itos=None):
+    """
+    Embedding average, vector extrema and greedy matching between gold and predicted sentences
+    The sentences of a batch are embedded at once into padded (batch, max length, dim) arrays, and the three
+    metrics are masked reductions over them.
+    """
+    def __init__(self, embeddig_dict=None, itos=None, matrix=None):
+        """
+        :param embeddig_dict: word -> vector, used for sentences given as strings
+        :param itos: id -> word, to look the ids up in embeddig_dict
+        :param matrix: V X D embedding matrix indexed by the word ids (e.g. TextData.pretrained_emb), used instead of
+            embeddig_dict for the id sequences
+        """
         self.embedding_dict = embeddig_dict
         self.itos = itos
+        self.matrix = np.asarray(matrix, dtype=np.float64) if matrix is not None else None
+        self.dim = self.matrix.shape[1] if self.matrix is not None else 300
 
     def eval_emb_metrics(self, gold, prediction):
         """
@@ -14,92 +28,231 @@ class EmbeddingMetrics():
         :param prediction:
         :return:
         """
-        g_emb, g_avg, g_extreme = self.get_metrics(gold)
-        p_emb, p_avg, p_extreme = self.get_metrics(prediction)
-
-        #print (g_avg, p_avg)
-        embedding_average = cosine_similarity(g_avg.reshape(1, 300), p_avg.reshape(1, 300))
-        vector_extrema = cosine_similarity(g_extreme.reshape(1, 300), p_extreme.reshape(1, 300))
-        greedy_matching = self.get_greedy_score(g_emb, p_emb)
+        embedding_average, vector_extrema, greedy_matching = self.get_scores_batch([gold], [prediction])
+        return embedding_average[0], vector_extrema[0], greedy_matching[0]
 
-        return embedding_average, vector_extrema, greedy_matching
-
-    def get_metrics(self, sent):
+    def get_embedding(self, word):
         """
-        Get all the metrics for the sentences
-        :param sent:
+        return vectors
+        :param word:
         :return:
         """
-        # get embeddings for all
-        embs = [self.get_embedding(word) for word in sent.split()]
-        if not embs:
-            avg_emb = np.zeros(300)
-        #print ([type(a) for a in embs])
-        else:
-            avg_emb = np.sum(embs, axis=0) / (np.linalg.norm(np.sum(embs, axis=0)) + 1e-12) # average
-        #print (embs)
         try:
-            maxemb = np.max(embs, axis=0)
-            minemb = np.min(embs, axis=0)
-            extreme_emb = list(map(lambda x, y: x if ((x>y or x<-y) and y>0) or ((x<y or x>-y) and y<0) else y, maxemb, minemb)) # vector extrema
-        except Exception:
-            #print (sent)
-            #print (embs)
-            extreme_emb = np.zeros(300)
+            return np.array(self.embedding_dict[word]).astype(np.float64)
+        except KeyError:
+            return np.random.rand(self.dim)
+
+    def embed_words(self, gold_batch, pred_batch):
+        """
+        Convert sentences (strings) into id sequences over their own vocabulary, each distinct word looked up once
+        :return: the gold and predicted id sequences, and the V X D matrix of their words
+        """
+        vocabulary = {}
+        gold_ids = [[vocabulary.setdefault(word, len(vocabulary)) for word in sent.split()] for sent in gold_batch]
+        pred_ids = [[vocabulary.setdefault(word, len(vocabulary)) for word in sent.split()] for sent in pred_batch]
+        matrix = np.zeros((max(len(vocabulary), 1), self.dim))
+        for word, i in vocabulary.items():
+            matrix[i] = self.get_embedding(word)
+        return gold_ids, pred_ids, matrix
 
-        return embs, avg_emb.reshape(-1, 1), np.array(extreme_emb).reshape(-1, 1)
+    def id_matrix(self):
+        """
+        The embedding of every word id: the given matrix, or the rows of embedding_dict in the itos order
+        """
+        if self.matrix is None:
+            self.matrix = np.stack([self.get_embedding(word) for word in self.itos])
+        return self.matrix
 
     @staticmethod
-    def get_greedy_score(g_emb, pred_emb):
+    def pad(sentences, matrix):
         """
-        Get greedy matching score
-        :param g_emb:
-        :param pred_emb:
-        :return:
+        :param sentences: list of id sequences
+        :return: B X L X D embeddings (zeros after the end of each sentence), B X L mask
         """
-        try:
-            sim_mat = cosine_similarity(g_emb, pred_emb)
-            greedy = (sim_mat.max(axis=0).mean() + sim_mat.max(axis=1).mean()) / 2
-        except Exception:
-            greedy = 0.0
+        ids, lengths = pad_sequences(sentences, pad=0)
+        mask = np.arange(ids.shape[1]) < lengths[:, None]
+        return matrix[ids] * mask[:, :, None], mask
 
+    @staticmethod
+    def cosine(a, b):
+        """
+        Cosine similarity of the last dimension, 0 for null vectors (as sklearn cosine_similarity)
+        """
+        norms = np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1)
+        return np.where(norms > 0, (a * b).sum(-1) / np.where(norms > 0, norms, 1), 0.0)
 
-        return greedy
+    @staticmethod
+    def get_sentence_vectors(emb, mask):
+        """
+        Embedding average and vector extrema of each sentence
+        :param emb: B X L X D
+        :param mask: B X L
+        :return: B X D average (normalized sum), B X D extrema
+        """
+        total = emb.sum(1)
+        avg_emb = total / (np.linalg.norm(total, axis=1, keepdims=True) + 1e-12)  # average
 
-    def get_embedding(self, word):
+        # vector extrema: per dimension, the max if the min is positive, or if it is negative with a smaller
+        # magnitude than the max, else the min
+        maxemb = np.where(mask[:, :, None], emb, -np.inf).max(1)
+        minemb = np.where(mask[:, :, None], emb, np.inf).min(1)
+        extreme_emb = np.where((minemb > 0) | ((minemb < 0) & (maxemb > -minemb)), maxemb, minemb)
+        extreme_emb[~mask.any(1)] = 0
+        return avg_emb, extreme_emb
+
+    def get_greedy_scores(self, g_emb, g_mask, pred_emb, p_mask):
         """
-        return vectors
-        :param word:
-        :return:
+        Get greedy matching score of each pair
+        :return: B, the average of the best match of each gold word and of each predicted word (0 if one sentence
+            is empty)
         """
-        try:
-            return np.array(self.embedding_dict[word]).astype(np.float64)
-        except KeyError:
-            return np.random.rand(300)
+        g_unit = g_emb / np.maximum(np.linalg.norm(g_emb, axis=-1, keepdims=True), 1e-300)
+        p_unit = pred_emb / np.maximum(np.linalg.norm(pred_emb, axis=-1, keepdims=True), 1e-300)
+        sim_mat = np.matmul(g_unit, p_unit.transpose(0, 2, 1))  # B X Lg X Lp
+        pair_mask = g_mask[:, :, None] & p_mask[:, None, :]
+        sim_mat = np.where(pair_mask, sim_mat, -np.inf)
+
+        g_count, p_count = g_mask.sum(1), p_mask.sum(1)
+        valid = (g_count > 0) & (p_count > 0)
+        best_for_pred = np.where(p_mask, sim_mat.max(1), 0).sum(1) / np.maximum(p_count, 1)
+        best_for_gold = np.where(g_mask, sim_mat.max(2), 0).sum(1) / np.maximum(g_count, 1)
+        return np.where(valid, (best_for_pred + best_for_gold) / 2, 0.0)
 
-    def get_metrics_batch(self, gold_batch, pred_batch):
+    def get_scores_batch(self, gold_batch, pred_batch, ids=False):
+        """
+        The 3 metrics of each pair
+        :param gold_batch: list of sentences (strings), or of id sequences if ids
+        :param pred_batch: idem
+        :return: B embedding average, B vector extrema, B greedy matching
+        """
+        if ids:
+            gold_ids, pred_ids, matrix = gold_batch, pred_batch, self.id_matrix()
+        else:
+            gold_ids, pred_ids, matrix = self.embed_words(gold_batch, pred_batch)
+        g_emb, g_mask = self.pad(gold_ids, matrix)
+        p_emb, p_mask = self.pad(pred_ids, matrix)
+
+        g_avg, g_extreme = self.get_sentence_vectors(g_emb, g_mask)
+        p_avg, p_extreme = self.get_sentence_vectors(p_emb, p_mask)
+        embedding_average = self.cosine(g_avg, p_avg)
+        vector_extrema = self.cosine(g_extreme, p_extreme)
+        greedy_matching = self.get_greedy_scores(g_emb, g_mask, p_emb, p_mask)
+        return embedding_average, vector_extrema, greedy_matching
+
+    def get_metrics_batch(self, gold_batch, pred_batch, ids=False):
         """
         Get results for batches
-        :param gold_batch:
-        :param pred_batch:
-        :return:
+        :param gold_batch: list of sentences (strings), or of id sequences if ids
+        :param pred_batch: idem
+        :return: the averages of the 3 metrics
         """
-        e_a, v_e, g_m = [], [], []
-        for g_s, p_s in zip(gold_batch, pred_batch):
-            avg, extreme, greedy = self.eval_emb_metrics(g_s, p_s)
-            e_a.append(avg)
-            v_e.append(extreme)
-            g_m.append(greedy)
+        e_a, v_e, g_m = self.get_scores_batch(gold_batch, pred_batch, ids=ids)
+        return np.average(e_a), np.average(v_e), np.average(g_m)
 
-            #print (g_m)
-        try:
-            return np.average(e_a), np.average(v_e), np.average(g_m)
-        except Exception as e:
-            print (np.average(e_a))
-            print (np.average(v_e))
-            print (np.average(g_m))
-            print (e)
 
+class EntityMetrics():
+    """
+    Entity F1 and KB retrieval accuracy of the responses, per intent (domain), accumulated batch by batch
+    The entities of a response are the distinct words of the response which are the subject or the object of one
+    of the triples of its KB. For each batch the comparisons are done on padded (batch, length) id arrays.
+    """
+    def __init__(self, id2intent, entity_ids=()):
+        """
+        :param id2intent: intent id -> intent (domain) name
+        :param entity_ids: ids of all the KB entity words of the corpus (e.g. TextData.entities_property keys), to
+            measure how often an entity that the model predicts comes from the KB of the sample
+        """
+        self.id2intent = id2intent
+        self.entity_ids = np.array(sorted(entity_ids), dtype=np.int64)
+        n_intents = max(id2intent) + 1 if id2intent else 1
+        self.true_positives = np.zeros(n_intents)
+        self.predicted = np.zeros(n_intents)
+        self.gold = np.zeros(n_intents)
+        self.f1_sum = np.zeros(n_intents)  # Sentence F1 of the responses which have gold entities
+        self.f1_count = np.zeros(n_intents)
+        self.known_predicted = np.zeros(n_intents)  # Predicted words that are KB entities of the corpus
+        self.retrieved = np.zeros(n_intents)  # ... and of the KB of the sample
+        self.responses = np.zeros(n_intents)
+
+    @staticmethod
+    def distinct_entities(ids, mask, entities):
+        """
+        :param ids: B X T
+        :param entities: B X K entity ids of the KB of each sample (-1 padded)
+        :return: B X T, True at the first occurrence of each KB entity
+        """
+        in_kb = (ids[:, :, None] == entities[:, None, :]).any(2) & mask
+        earlier = np.tril(np.ones((ids.shape[1], ids.shape[1]), dtype=bool), k=-1)
+        repeated = ((ids[:, :, None] == ids[:, None, :]) & earlier).any(2)
+        return in_kb & ~repeated
+
+    def update(self, hypotheses, references, kb, intents):
+        """
+        :param hypotheses: list of predicted id sequences
+        :param references: list of target id sequences
+        :param kb: B X M X 3 KB triples of each sample, padded with -1
+        :param intents: B intent ids
+        """
+        kb = np.asarray(kb, dtype=np.int64)
+        intents = np.asarray(intents, dtype=np.int64)
+        entities = np.concatenate([kb[:, :, 0], kb[:, :, 2]], 1) if kb.size else np.full((len(intents), 1), -1)
+        predictions, prediction_lengths = pad_sequences(hypotheses, pad=-2)  # The paddings never match anything
+        targets, target_lengths = pad_sequences(references, pad=-3)
+        prediction_mask = np.arange(predictions.shape[1]) < prediction_lengths[:, None]
+        target_mask = np.arange(targets.shape[1]) < target_lengths[:, None]
+
+        predicted = self.distinct_entities(predictions, prediction_mask, entities)
+        gold = self.distinct_entities(targets, target_mask, entities)
+        in_gold = ((predictions[:, :, None] == targets[:, None, :]) & gold[:, None, :]).any(2)
+        true_positives = (predicted & in_gold).sum(1)
+        n_predicted, n_gold = predicted.sum(1), gold.sum(1)
+
+        precision = true_positives / np.maximum(n_predicted, 1)
+        recall = true_positives / np.maximum(n_gold, 1)
+        f1 = np.where(true_positives > 0, 2 * precision * recall / np.maximum(precision + recall, 1e-12), 0.0)
 
+        # KB retrieval: every predicted word which is an entity of the corpus, and if it is in the sample KB
+        known = np.isin(predictions, self.entity_ids) & prediction_mask
+        retrieved = known & (predictions[:, :, None] == entities[:, None, :]).any(2)
 
+        np.add.at(self.true_positives, intents, true_positives)
+        np.add.at(self.predicted, intents, n_predicted)
+        np.add.at(self.gold, intents, n_gold)
+        np.add.at(self.f1_sum, intents, np.where(n_gold > 0, f1, 0.0))
+        np.add.at(self.f1_count, intents, n_gold > 0)
+        np.add.at(self.known_predicted, intents, known.sum(1))
+        np.add.at(self.retrieved, intents, retrieved.sum(1))
+        np.add.at(self.responses, intents, 1)
 
+    @staticmethod
+    def scores(true_positives, predicted, gold, f1_sum, f1_count, known_predicted, retrieved, responses):
+        return {
+            'micro_f1': 2 * true_positives / (predicted + gold) if predicted + gold else 0.0,
+            'macro_f1': f1_sum / f1_count if f1_count else 0.0,
+            'kb_accuracy': retrieved / known_predicted if known_predicted else 0.0,
+            'responses': int(responses),
+        }
+
+    def results(self):
+        """
+        :return: dict intent name -> {micro_f1, macro_f1, kb_accuracy, responses}, plus 'all' for the whole set
+            (micro F1 from the summed counts, macro F1 the average F1 of the responses with gold entities)
+        """
+        counts = (self.true_positives, self.predicted, self.gold, self.f1_sum, self.f1_count, self.known_predicted,
+                  self.retrieved, self.responses)
+        results = {}
+        for intent_id, name in sorted(self.id2intent.items()):
+            if self.responses[intent_id]:
+                results[name] = self.scores(*[count[intent_id] for count in counts])
+        results['all'] = self.scores(*[count.sum() for count in counts])
+        return results
+
+    def table(self):
+        """
+        :return: the results, one line per domain
+        """
+        lines = ['{:<20} {:>9} {:>9} {:>9} {:>9}'.format('domain', 'micro F1', 'macro F1', 'KB acc', 'responses')]
+        for name, scores in self.results().items():
+            lines.append('{:<20} {:>9.4f} {:>9.4f} {:>9.4f} {:>9d}'.format(
+                name, scores['micro_f1'], scores['macro_f1'], scores['kb_accuracy'], scores['responses']))
+        return '\n'.join(lines)
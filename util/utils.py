@@ -25,7 +25,7 @@ def masked_cross_entropy(logits, target, mask):
     logits_flat = logits.view(-1, logits.size(-1)) ## -1 means inferred from other dimensions
     #print (logits_flat)
     # log_probs_flat: (batch * max_len, num_classes)
-    log_probs_flat = functional.log_softmax(logits_flat,dim=1)
+    log_probs_flat = functional.log_softmax(logits_flat.float(),dim=1)  # float32, even for bfloat16 logits
     #print (log_probs_flat)
     # target_flat: (batch * max_len, 1)
     target_flat = target.view(-1, 1).long()
@@ -48,38 +48,45 @@ def save_model(model, name):
     torch.save(model.state_dict(), 'models/{}.bin'.format(name))
 
 
-def compute_ent_loss(embedding, logits, target, ent_mask, target_mask):
+class EntityLoss(nn.Module):
     """
-    Compute loss for entities
-    :param embedding:
-    :param logits:
-    :param target:
-    :param ent_mask: entity mask = 1 if entity otherwise 0
-    :param target_mask:
-    :return:
+    Entity loss: cosine distance between the embeddings of the predicted and of the target words, at the positions
+    where the target is a KB entity. Only those positions are predicted, embedded and compared: the embedding rows
+    of the words involved are normalized once per call and gathered by index.
     """
-    cosine_loss = nn.CosineSimilarity(dim=-1)
+    def __init__(self, eps=1e-8):
+        super(EntityLoss, self).__init__()
+        self.eps = eps
+
+    def forward(self, embedding, outputs, target, ent_mask, target_mask, predict=None):
+        """
+        :param embedding: the word embedding (nn.Embedding)
+        :param outputs: S X B X V decoder logits (or S X B X H features, see predict)
+        :param target: B X S target words
+        :param ent_mask: B X S entity mask = 1 if entity otherwise 0
+        :param target_mask: B X S
+        :param predict: function mapping the selected N X V (or N X H) outputs to the N predicted words (default argmax)
+        :return: the sum of the entity distances, divided by the number of target words
+        """
+        weights = ent_mask.to(target_mask) * target_mask  # Same device and dtype as the target mask
+        positions = weights != 0
+        length = target_mask.sum().float() + self.eps
+        if not positions.any():
+            return outputs.new_zeros(()).float()
+
+        selected = outputs.detach().transpose(0, 1)[positions]  # N X V, the argmax is not differentiable anyway
+        predictions = predict(selected) if predict is not None else selected.argmax(-1)
+        targets = target[positions].long()
+
+        # Normalized embedding of each word involved, computed once
+        words, index = torch.unique(torch.cat((predictions, targets)), return_inverse=True)
+        word_emb = embedding(words).float()
+        word_emb = word_emb / word_emb.norm(dim=-1, keepdim=True).clamp(min=self.eps)
+        pred_index, target_index = index.split(predictions.size(0))
+
+        cosine = (word_emb[pred_index] * word_emb[target_index]).sum(-1)
+        return ((1 - cosine) * weights[positions].float()).sum() / length
 
-    pred_out = torch.argmax(logits, dim=-1).transpose(0,1)  # B X S
-
-    pred_out = ent_mask * pred_out
-
-    pred_emb = embedding(pred_out)  # B X S X E
-
-    target_ent = target * ent_mask
-
-    target_emb = embedding(target_ent)  # B X S X E
-    if torch.Tensor.type(target_emb) == "torch.FloatTensor":
-        entity_loss = (1 - cosine_loss(target_emb, pred_emb))* ent_mask.type(torch.Tensor)  # B X S
-    else:
-        entity_loss = (1 - cosine_loss(target_emb, pred_emb)) * ent_mask.type(torch.Tensor).cuda()  # B X S
-    entity_loss = entity_loss * target_mask
-
-    length = torch.sum(target_mask, dim=1)
-
-    entity_loss = entity_loss.sum() / (length.float().sum() + 1e-8)
-
-    return entity_loss
 
 def load_model(model, name, gpu=True):
     if gpu: